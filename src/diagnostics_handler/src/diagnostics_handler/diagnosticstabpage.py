@@ -4,14 +4,35 @@ import rospy
 from txosc import osc
 from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 
+from array import array
+import bisect
+import collections
 import copy
 
 from touchosc_bridge.abstracttabpage import AbstractTabpageHandler
+from twisted.internet import reactor
+
+def format_duration(seconds):
+    """
+    Coarse text for a duration, so that a displayed time in state only
+    changes once a minute.
+    @rtype: C{str}
+    """
+    if seconds < 60:
+        return "< 1 min"
+    elif seconds < 3600:
+        return "%d min" % (seconds // 60)
+    else:
+        return "%d h" % (seconds // 3600)
 
 class DiagnosticsClient(object):
     """
     A class to represent the display state of an iOS client
     """
+    _DIAGNOSTICS_ADDRESSES = ("dled%i/color", "dled%i",
+                              "dlabel%i", "dlabel%i/color")
+    _DETAIL_ADDRESSES = ("key%i", "value%i")
+
     def __init__(self, client_name, client_type, client_topic):
         """
         Constructor for DiagnosticsClient.
@@ -32,17 +53,49 @@ class DiagnosticsClient(object):
         self.detail_display = None
         self.display_level = 1
         self.expanded_display = None
+        self.filter_prefix = None
+        self.filter_levels = None
 
         self.name = client_name
         self.type = client_type
         self.topic = client_topic
 
+    @property
+    def filtered(self):
+        """
+        True if the list display shows a filtered view instead of the tree.
+        
+        @type: C{bool}
+        """
+        return bool(self.filter_prefix) or self.filter_levels is not None
+
+    def set_filter(self, prefix=None, levels=None):
+        """
+        Set the name prefix and severity filter of the list display.  Passing
+        no arguments returns the list display to the tree view.
+        
+        @param prefix: Only show items whose name starts with this prefix
+        @type prefix: C{string}
+        @param levels: Only show items whose own level is one of these
+        @type levels: C{frozenset}
+        """
+        self.filter_prefix = prefix or None
+        self.filter_levels = levels or None
+        self._diagnostics_offset = 0
+
     def set_detailed_display(self, index):
         detailed_index = self._diagnostics_offset + index
         try:
             (name, _, _) = self.display_list[detailed_index]
             if self.detail_display and name == self.detail_display.name:
-                if self.expanded_display and name == self.expanded_display.name:
+                if self.filtered:
+                    # Jump from the filtered view to the item in the tree
+                    if self.diag_db.get_number_children(name) > 0:
+                        self.set_filter()
+                        self.expanded_display = self.detail_display
+                        self.display_level = self.detail_display.get_level() + 1
+                        self.detail_display = None
+                elif self.expanded_display and name == self.expanded_display.name:
                     parent = self.expanded_display.get_parent_name()
                     if parent == '':
                         self.expanded_display = None
@@ -60,34 +113,61 @@ class DiagnosticsClient(object):
         except:
             return
 
+    def invalidate_display(self):
+        """
+        Forget the rendered row state so that the next refresh resends every
+        row.  Used when the device display may no longer match what was sent.
+        """
+        self._diagnostics_rows = [[None] * 4
+                                  for _ in range(self._len_diagnostics)]
+        self._detail_rows = [[None] * 2 for _ in range(self._len_detail)]
+        self._rendered_list_key = None
+        self._rendered_detail_key = None
+
+    def _drop_expired(self):
+        """
+        Stop showing items that have been removed from the database.
+        """
+        data = self.diag_db.diagnostics_data
+        if (self.expanded_display and
+            data.get(self.expanded_display.name) is not self.expanded_display):
+            self.expanded_display = None
+            self.display_level = 1
+            self._diagnostics_offset = 0
+        if (self.detail_display and
+            data.get(self.detail_display.name) is not self.detail_display):
+            self.detail_display = None
+            self._detail_offset = 0
+
+    def _diff_row(self, rows, index, addresses, values, to_display):
+        """
+        Compare one display row to its last rendered state, appending a message
+        for each field whose value changed.
+        """
+        row = rows[index]
+        for field in range(len(values)):
+            if row[field] != values[field]:
+                row[field] = values[field]
+                to_display.append(osc.Message(addresses[field] % (index + 1),
+                                              values[field]))
+
     def clear_diagnostics_display(self):
-        it = 1
         to_display = []
-        while it <= self._len_diagnostics:
-            to_display.append(osc.Message("dled%i/color" % it, 'gray'))
-            to_display.append(osc.Message("dled%i" % it, 0.0))
-            to_display.append(osc.Message("dlabel%i/color" % it, 'gray'))
-            to_display.append(osc.Message("dlabel%i" % it, ''))
-            it += 1
+        self._diagnostics_rows = [[None] * 4
+                                  for _ in range(self._len_diagnostics)]
+        self._rendered_list_key = None
+        for it in range(self._len_diagnostics):
+            self._diff_row(self._diagnostics_rows, it,
+                           self._DIAGNOSTICS_ADDRESSES,
+                           ('gray', 0.0, '', 'gray'), to_display)
         to_display.append(osc.Message("dfader", 0.0))
         return to_display
 
     def clear_detail_display(self):
-        it = 1
-        to_display = []
         self.detail_display = None
-        while it <= self._len_detail:
-            to_display.append(osc.Message("key%i" % it, ''))
-            to_display.append(osc.Message("value%i" % it, ''))
-            it += 1
-        to_display.append(osc.Message("kvfader", 0.0))
-        to_display.append(osc.Message("deviceled/color", "gray"))
-        to_display.append(osc.Message("deviceled", 0.0))
-        to_display.append(osc.Message("name", ""))
-        to_display.append(osc.Message("hardware_id", ""))
-        to_display.append(osc.Message("message", ""))
-        to_display.append(osc.Message("stamp", ""))
-        return to_display
+        self._detail_rows = [[None] * 2 for _ in range(self._len_detail)]
+        self._rendered_detail_key = None
+        return self.update_detail_display()
 
     def clear_system_status(self):
         to_display = []
@@ -95,40 +175,75 @@ class DiagnosticsClient(object):
         to_display.append(osc.Message("statusled", 0.0))
         return to_display
 
+    def clear_filter_display(self):
+        """
+        Switch off the toggles of the severity filter control, which may be
+        laid out as a single row or column.
+        @return: A list of messages to be sent
+        @rtype: C{list}
+        """
+        to_display = [osc.Message("dfilter/1/1", 0.0)]
+        for i in range(2, 5):
+            to_display.append(osc.Message("dfilter/1/%i" % i, 0.0))
+            to_display.append(osc.Message("dfilter/%i/1" % i, 0.0))
+        return to_display
+
     def clear_display(self):
         to_display = []
         to_display.extend(self.clear_system_status())
         to_display.extend(self.clear_detail_display())
         to_display.extend(self.clear_diagnostics_display())
+        to_display.extend(self.clear_filter_display())
         return to_display
 
     def update_diagnostics_display(self, fader=False):
-        if self.expanded_display:
-            self.display_list = self.diag_db.get_display_list(root=self.expanded_display.name,
-                                                              display_level=self.display_level)
+        """
+        Updates the diagnostics list display on the iOS device.  Only rows
+        whose LED colour, label or label colour differ from what was last
+        sent are included, and nothing is rendered if neither the database
+        version nor the view changed since the last update.
+        @return: A list of messages to be sent
+        @rtype: C{list}
+        """
+        self._drop_expired()
+        detail_name = self.detail_display.name if self.detail_display else None
+        expanded_name = self.expanded_display.name if self.expanded_display else None
+        if self.filtered:
+            self.display_list = self.diag_db.get_filtered_list(self.filter_prefix,
+                                                               self.filter_levels)
         else:
-            self.display_list = self.diag_db.get_display_list(display_level=self.display_level)
-        it = 1
+            self.display_list = self.diag_db.get_display_list(root=expanded_name,
+                                                              display_level=self.display_level)
+        if self._diagnostics_offset > self.get_max_diagnostics_offset():
+            self._diagnostics_offset = self.get_max_diagnostics_offset()
+        key = (self.diag_db, self.diag_db.version, expanded_name,
+               self.display_level, self.filter_prefix, self.filter_levels,
+               self._diagnostics_offset, detail_name)
+        if key == self._rendered_list_key:
+            return []
+        self._rendered_list_key = key
+        window = self.diag_db.get_display_window(expanded_name,
+                                                 self.display_level,
+                                                 self._diagnostics_offset,
+                                                 self._len_diagnostics,
+                                                 self.filter_prefix,
+                                                 self.filter_levels)
         to_display = []
         length = len(self.display_list)
-        for (long_name, name, color) in self.display_list[self._diagnostics_offset:]:
-            to_display.append(osc.Message("dled%i/color" % it, color))
-            to_display.append(osc.Message("dled%i" % it, 1.0))
-            to_display.append(osc.Message("dlabel%i" % it, name))
-            if self.detail_display and long_name == self.detail_display.name:
-                to_display.append(osc.Message("dlabel%i/color" % it, "blue"))
-            elif self.expanded_display and long_name == self.expanded_display.name:
-                to_display.append(osc.Message("dlabel%i/color" % it, "orange"))
+        for it in range(self._len_diagnostics):
+            if it < len(window):
+                (long_name, name, color) = window[it]
+                if long_name == detail_name:
+                    label_color = "blue"
+                elif long_name == expanded_name:
+                    label_color = "orange"
+                else:
+                    label_color = "gray"
+                values = (color, 1.0, name, label_color)
             else:
-                to_display.append(osc.Message("dlabel%i/color" % it, "gray"))
-            it += 1
-            if it > self._len_diagnostics: break;
-        while it <= self._len_diagnostics:
-            to_display.append(osc.Message("dled%i/color" % it, 'gray'))
-            to_display.append(osc.Message("dled%i" % it, 0.0))
-            to_display.append(osc.Message("dlabel%i" % it, ''))
-            to_display.append(osc.Message("dlabel%i/color" % it, 'gray'))
-            it += 1
+                values = ('gray', 0.0, '', 'gray')
+            self._diff_row(self._diagnostics_rows, it,
+                           self._DIAGNOSTICS_ADDRESSES, values, to_display)
         if fader:
             if length <= self._len_diagnostics:
                 value = 1.0
@@ -144,27 +259,48 @@ class DiagnosticsClient(object):
 
     def update_detail_display(self, fader=False):
         """
-        Updates the detailed key/value display on the iOS device.
+        Updates the detailed key/value display on the iOS device.  Only rows
+        whose key or value differ from what was last sent are included, and
+        nothing is rendered if the selected item has not changed since the
+        last update.
         @return: A list of messages to be sent
         @rtype: C{list}
         """
-        if self.detail_display is None:
-            display_list = []
-            return self.clear_detail_display()
+        self._drop_expired()
+        item = self.detail_display
+        if item is None:
+            key = (None, self._detail_offset)
         else:
-            display_list = self.detail_display.get_display_list()
-        it = 1
+            key = (item, item.content_version, item.level_version,
+                   self._detail_offset,
+                   format_duration(self.diag_db.get_time_in_state(item.name)))
+        if key == self._rendered_detail_key:
+            return []
+        self._rendered_detail_key = key
         to_display = []
+        if self.detail_display is None:
+            for it in range(self._len_detail):
+                self._diff_row(self._detail_rows, it, self._DETAIL_ADDRESSES,
+                               ('', ''), to_display)
+            to_display.append(osc.Message("kvfader", 0.0))
+            to_display.append(osc.Message("deviceled/color", "gray"))
+            to_display.append(osc.Message("deviceled", 0.0))
+            to_display.append(osc.Message("name", ""))
+            to_display.append(osc.Message("hardware_id", ""))
+            to_display.append(osc.Message("message", ""))
+            to_display.append(osc.Message("stamp", ""))
+            return to_display
+        display_list = self.get_detail_list()
         length = len(display_list)
-        for (key, value) in display_list[self._detail_offset:]:
-            to_display.append(osc.Message("key%i" % it, key))
-            to_display.append(osc.Message("value%i" % it, value))
-            it += 1
-            if it > self._len_detail: break;
-        while it <= self._len_detail:
-            to_display.append(osc.Message("key%i" % it, ''))
-            to_display.append(osc.Message("value%i" % it, ''))
-            it += 1
+        window = display_list[self._detail_offset:
+                              self._detail_offset + self._len_detail]
+        for it in range(self._len_detail):
+            if it < len(window):
+                values = window[it]
+            else:
+                values = ('', '')
+            self._diff_row(self._detail_rows, it, self._DETAIL_ADDRESSES,
+                           values, to_display)
         if fader:
             if length <= self._len_detail:
                 value = 1.0
@@ -177,9 +313,9 @@ class DiagnosticsClient(object):
         to_display.append(osc.Message("deviceled", 1.0))
         to_display.append(osc.Message("name", self.detail_display.name))
         to_display.append(osc.Message("hardware_id",
-                                      self.detail_display.msg.hardware_id))
+                                      self.detail_display.hardware_id))
         to_display.append(osc.Message("message",
-                                      self.detail_display.msg.message))
+                                      self.detail_display.message))
         to_display.append(osc.Message("stamp",
                                       str(self.detail_display.stamp.to_sec())))
         return to_display
@@ -198,10 +334,12 @@ class DiagnosticsClient(object):
             self._len_diagnostics = 16
             self._len_detail = 8
             self.client_type = "ipad"
+            self.invalidate_display()
         elif type.lower() == "ipod":
             self._len_diagnostics = 10
             self._len_detail = 6
             self.client_type = "ipod"
+            self.invalidate_display()
         else:
             raise ValueError("Client type %s is not supported" % type)
 
@@ -253,16 +391,30 @@ class DiagnosticsClient(object):
     @detail_offset.setter
     def detail_offset(self, offset):
         if self.detail_display is not None:
-            max_offset = self.detail_display.get_length() - self._len_detail
-            max_offset = 0 if max_offset < 0 else max_offset
+            max_offset = self.get_max_detail_offset()
             min_offset = 0
             if offset <= max_offset and offset >= min_offset:
                 self._detail_offset = offset
         else:
             self._detail_offset = offset
 
+    def get_detail_list(self):
+        """
+        Key/value pairs of the detailed item, followed by a summary of its
+        level history.
+        @rtype: C{list}
+        """
+        name = self.detail_display.name
+        display_list = self.detail_display.get_display_list()
+        display_list.append(("Level changes",
+                             str(self.diag_db.get_flap_count(name))))
+        display_list.append(("Time in state", format_duration(
+                             self.diag_db.get_time_in_state(name))))
+        return display_list
+
     def get_max_detail_offset(self):
-        max_offset = self.detail_display.get_length() - self._len_detail
+        # Key/value pairs plus the two history rows of get_detail_list
+        max_offset = len(self.detail_display.keys) + 2 - self._len_detail
         max_offset = 0 if max_offset < 0 else max_offset
         return max_offset
 
@@ -272,106 +424,609 @@ class DiagnosticsClient(object):
         return max_offset
 
 class DiagnosticsItem(object):
+    """
+    Most recent state of a single DiagnosticStatus name.
+    
+    Path components are computed once at construction and key/value pairs
+    are kept in parallel lists that are reused across updates.
+    C{content_version} and C{level_version} increase whenever the displayed
+    content or the level of the item changes.
+    """
     COLORS = {0: "green", 1: "yellow", 2: "red", 3:"gray"}
+    __slots__ = ('name', 'parent_name', 'nice_name', 'level', 'stamp',
+                 'status', 'hardware_id', 'message', 'keys', 'values',
+                 'content_version', 'level_version', 'slot')
+
     def __init__(self, name):
         self.name = name
-        self.kv_dict = {}
+        (parent_name, _, nice_name) = name.rpartition('/')
+        self.parent_name = parent_name.strip()
+        self.nice_name = nice_name
+        self.level = name.count('/')
         self.stamp = None
         self.status = 3
-        self.kv_display = []
+        self.hardware_id = ''
+        self.message = ''
+        self.keys = []
+        self.values = []
+        self.content_version = 0
+        self.level_version = 0
+        self.slot = None
 
     def update(self, stamp, msg):
-        self.stamp = stamp
-        self.status = msg.level
-        self.msg = msg
-        self.kv_display = []
-        for value in msg.values:
-            self.kv_dict[value.key] = value.value
-            self.kv_display.append(value.key)
+        """
+        Update the item from a DiagnosticStatus message.
+        
+        @return: True if the key/value pairs changed
+        @rtype: C{bool}
+        """
+        if msg.level != self.status:
+            self.status = msg.level
+            self.level_version += 1
+        if (stamp != self.stamp or msg.hardware_id != self.hardware_id or
+            msg.message != self.message):
+            self.stamp = stamp
+            self.hardware_id = msg.hardware_id
+            self.message = msg.message
+            self.content_version += 1
+        keys = self.keys
+        values = self.values
+        new_values = msg.values
+        if len(new_values) == len(keys):
+            for i in xrange(len(keys)):
+                if (keys[i] != new_values[i].key or
+                    values[i] != new_values[i].value):
+                    break
+            else:
+                return False
+        keys[:] = [kv.key for kv in new_values]
+        values[:] = [kv.value for kv in new_values]
+        self.content_version += 1
+        return True
+
+    def mark_stale(self):
+        """
+        Show the item as stale until its next update.
+        """
+        if self.status != DiagnosticStatus.STALE:
+            self.status = DiagnosticStatus.STALE
+            self.level_version += 1
 
     def get_parent_name(self):
-        return ('/'.join(self.name.split('/')[:-1])).strip()
+        return self.parent_name
 
     def get_nice_name(self):
-        return self.name.split('/')[-1]
+        return self.nice_name
 
     def get_level(self):
-        return len(self.name.split('/')) - 1
+        return self.level
 
     def get_color(self):
         return self.COLORS[self.status]
 
     def get_length(self):
-        return len(self.kv_dict)
+        return len(self.keys)
 
     def get_display_list(self):
-        disp_list = []
-        for key in self.kv_display:
-            disp_list.append((key, self.kv_dict[key]))
-        return disp_list
+        return zip(self.keys, self.values)
 
 class DiagnosticsData(object):
+    """
+    Store of the most recent DiagnosticStatus for each status name on a topic.
+
+    Names are indexed as a tree as they are first seen: every parent name keeps
+    a sorted list of its children and every level keeps a sorted list of its
+    members, so display queries only touch the names they return.  Each name
+    also keeps a count of the levels in its subtree, so aggregate colours and
+    the system status are read without a scan.
+
+    The last C{history_length} level changes of every item are kept in
+    preallocated arrays indexed by the item's slot, and all level changes
+    go to a shared log of C{log_length} entries that answers which items
+    changed recently.
+    """
     COLORS = {0: "green", 1: "yellow", 2: "red", 3:"gray"}
-    def __init__(self, topic):
+    def __init__(self, topic, stale_timeout=5.0, expire_timeout=300.0,
+                 max_items=50000, history_length=16, log_length=4096):
+        """
+        Constructor for DiagnosticsData.
+        
+        @param topic: Topic that the data is received on
+        @type topic: C{string}
+        @param stale_timeout: Seconds without an update before an item is
+        shown as stale
+        @type stale_timeout: C{float}
+        @param expire_timeout: Seconds without an update before a stale item
+        is removed
+        @type expire_timeout: C{float}
+        @param max_items: Maximum number of items kept; the least recently
+        updated items are removed first
+        @type max_items: C{int}
+        @param history_length: Number of level changes kept per item
+        @type history_length: C{int}
+        @param log_length: Number of level changes kept across all items
+        @type log_length: C{int}
+        """
         self.diagnostics_data = {}
         self.diagnostics_display = []
-        self.system_status = DiagnosticStatus.OK
         self.topic = topic
+        self.stale_timeout = stale_timeout
+        self.expire_timeout = expire_timeout
+        self.max_items = max_items
+        self.dirty = False
+        self.structure_version = 0
+        self.level_version = 0
+        self._render_cache = {}
+        self._render_cache_version = None
+        self._children = {}
+        self._levels = {}
+        # Number of OK/WARN/ERROR/STALE items in the subtree of every name,
+        # with the whole store counted under ''
+        self._rollup = {'': [0, 0, 0, 0]}
+        # Names of all items, bucketed by their own severity
+        self._severity = [set(), set(), set(), set()]
+        # Names ordered by last update, split by whether they are stale
+        self._fresh = collections.OrderedDict()
+        self._stale = collections.OrderedDict()
+        self._has_warned_no_name = False
+        self._now = 0.0
+        # Per slot level history: ring buffers of history_length entries,
+        # the next write position, the number of changes recorded and a
+        # generation that is bumped whenever the slot is reused
+        self.history_length = history_length
+        self._slot_names = []
+        self._free_slots = []
+        self._hist_time = array('d')
+        self._hist_level = array('b')
+        self._hist_pos = array('l')
+        self._hist_count = array('l')
+        self._slot_gen = array('l')
+        # Ring buffer of (slot, generation, time, level) for all items
+        self.log_length = log_length
+        self._log_slot = array('l', [0]) * log_length
+        self._log_gen = array('l', [0]) * log_length
+        self._log_time = array('d', [0.0]) * log_length
+        self._log_level = array('b', [0]) * log_length
+        self._log_pos = 0
+        self._log_count = 0
 
-    def add_message(self, msg):
+    def add_message(self, msg, now=None):
         if msg is not None:
+            if now is None:
+                now = rospy.get_time()
+            self._now = now
             for message in msg.status:
                 if not message.name and not self._has_warned_no_name:
                     rospy.logwarn('''DiagnosticStatus message with no "name". 
                     Unable to add to handler. Message: %s, hardware ID: %s, 
-                    level: %d''' % (s.message, s.hardware_id, s.level))
+                    level: %d''' % (message.message, message.hardware_id,
+                                     message.level))
                     self._has_warned_no_name = True
                 if not message.name:
                     continue
                 if len(message.name) > 0 and message.name[0] != '/':
                     message.name = '/' + message.name
-                if not self.diagnostics_data.has_key(message.name):
-                    self.diagnostics_data[message.name] = DiagnosticsItem(message.name)
-                self.diagnostics_data[message.name].update(msg.header.stamp, message)
-                if message.level != 3:
-                    self.system_status = max(self.system_status, message.level)
-            self.diagnostics_display = sorted(self.diagnostics_data.keys())
+                item = self.diagnostics_data.get(message.name)
+                if item is None:
+                    item = DiagnosticsItem(message.name)
+                    self.diagnostics_data[message.name] = item
+                    self._index_item(item)
+                    self.structure_version += 1
+                else:
+                    if self._stale.pop(message.name, None) is None:
+                        del self._fresh[message.name]
+                self._fresh[message.name] = now
+                level = item.status
+                item.update(msg.header.stamp, message)
+                if item.status != level:
+                    self._level_changed(item, level, now)
+                elif not self._hist_count[item.slot]:
+                    self._record_level(item, now)
+            while len(self.diagnostics_data) > self.max_items:
+                self._evict_oldest()
+            self.dirty = True
+
+    def expire(self, now=None):
+        """
+        Mark items that have not been updated within C{stale_timeout} as stale
+        and remove stale items older than C{expire_timeout}.
+        
+        Only the oldest entries of the age index are visited, so the cost
+        depends on the number of items that change state.
+        @return: True if any item changed
+        @rtype: C{bool}
+        """
+        if now is None:
+            now = rospy.get_time()
+        self._now = now
+        changed = False
+        while self._fresh:
+            (name, stamp) = next(self._fresh.iteritems())
+            if now - stamp < self.stale_timeout:
+                break
+            del self._fresh[name]
+            self._stale[name] = stamp
+            item = self.diagnostics_data[name]
+            if item.status != DiagnosticStatus.STALE:
+                level = item.status
+                item.mark_stale()
+                self._level_changed(item, level, now)
+                changed = True
+        while self._stale:
+            (name, stamp) = next(self._stale.iteritems())
+            if now - stamp < self.expire_timeout:
+                break
+            self._evict_oldest()
+            changed = True
+        if changed:
+            self.dirty = True
+        return changed
+
+    def _evict_oldest(self):
+        """
+        Remove the least recently updated item, preferring stale items.
+        """
+        if self._stale:
+            (name, _) = self._stale.popitem(last=False)
+        else:
+            (name, _) = self._fresh.popitem(last=False)
+        item = self.diagnostics_data.pop(name)
+        self._unindex_item(item)
+        self.structure_version += 1
+
+    def _level_changed(self, item, old_level, now):
+        """
+        Move an item whose level changed between severity buckets, update
+        the counts of its subtree and record the change in its history.
+        """
+        self._adjust_rollup(item.name, old_level, -1)
+        self._adjust_rollup(item.name, item.status, 1)
+        self._severity[old_level].discard(item.name)
+        self._severity[item.status].add(item.name)
+        self.level_version += 1
+        self._record_level(item, now)
+
+    def _record_level(self, item, now):
+        """
+        Append the current level of an item to its history and to the
+        shared change log.
+        """
+        slot = item.slot
+        length = self.history_length
+        pos = self._hist_pos[slot]
+        self._hist_time[slot * length + pos] = now
+        self._hist_level[slot * length + pos] = item.status
+        self._hist_pos[slot] = (pos + 1) % length
+        self._hist_count[slot] += 1
+        pos = self._log_pos
+        self._log_slot[pos] = slot
+        self._log_gen[pos] = self._slot_gen[slot]
+        self._log_time[pos] = now
+        self._log_level[pos] = item.status
+        self._log_pos = (pos + 1) % self.log_length
+        if self._log_count < self.log_length:
+            self._log_count += 1
+
+    def _allocate_slot(self, item):
+        """
+        Give an item a history slot, reusing the slot of a removed item when
+        one is free.
+        """
+        if self._free_slots:
+            slot = self._free_slots.pop()
+            self._slot_names[slot] = item.name
+            self._hist_pos[slot] = 0
+            self._hist_count[slot] = 0
+        else:
+            slot = len(self._slot_names)
+            self._slot_names.append(item.name)
+            self._hist_time.extend(array('d', [0.0]) * self.history_length)
+            self._hist_level.extend(array('b', [0]) * self.history_length)
+            self._hist_pos.append(0)
+            self._hist_count.append(0)
+            self._slot_gen.append(0)
+        item.slot = slot
+
+    def _free_slot(self, item):
+        slot = item.slot
+        self._slot_names[slot] = None
+        self._slot_gen[slot] += 1
+        self._free_slots.append(slot)
+        item.slot = None
+
+    def get_history(self, name):
+        """
+        Recorded level changes of an item, oldest first.
+        @return: A list of (time, level) tuples
+        @rtype: C{list}
+        """
+        item = self.diagnostics_data.get(name)
+        if item is None:
+            return []
+        slot = item.slot
+        length = self.history_length
+        count = min(self._hist_count[slot], length)
+        pos = self._hist_pos[slot]
+        base = slot * length
+        history = []
+        for i in xrange(pos - count, pos):
+            history.append((self._hist_time[base + i % length],
+                            self._hist_level[base + i % length]))
+        return history
+
+    def get_flap_count(self, name):
+        """
+        Number of level changes of an item since it was first seen.
+        @rtype: C{int}
+        """
+        item = self.diagnostics_data.get(name)
+        if item is None or not self._hist_count[item.slot]:
+            return 0
+        return self._hist_count[item.slot] - 1
+
+    def get_time_in_state(self, name, now=None):
+        """
+        Seconds an item has been at its current level, as of C{now} or the
+        time of the last update or expiry.
+        @rtype: C{float}
+        """
+        item = self.diagnostics_data.get(name)
+        if item is None or not self._hist_count[item.slot]:
+            return 0.0
+        if now is None:
+            now = self._now
+        length = self.history_length
+        pos = (self._hist_pos[item.slot] - 1) % length
+        return now - self._hist_time[item.slot * length + pos]
+
+    def get_changes(self, seconds, now=None):
+        """
+        Level changes of all items in the last C{seconds} seconds, newest
+        first.  Only the shared change log is read, so the cost depends on
+        the number of changes rather than the number of items; changes older
+        than the last C{log_length} are not reported.
+        @return: A list of (name, time, level) tuples
+        @rtype: C{list}
+        """
+        if now is None:
+            now = self._now
+        since = now - seconds
+        changes = []
+        pos = self._log_pos
+        for _ in xrange(self._log_count):
+            pos = (pos - 1) % self.log_length
+            stamp = self._log_time[pos]
+            if stamp < since:
+                break
+            slot = self._log_slot[pos]
+            if self._log_gen[pos] == self._slot_gen[slot]:
+                changes.append((self._slot_names[slot], stamp,
+                                self._log_level[pos]))
+        return changes
+
+    def _adjust_rollup(self, name, level, delta):
+        """
+        Add C{delta} to the count of C{level} for C{name} and each of its
+        ancestors.  Called only when an item is added, removed or changes
+        level.
+        """
+        rollup = self._rollup
+        while True:
+            counts = rollup.get(name)
+            if counts is None:
+                counts = rollup[name] = [0, 0, 0, 0]
+            counts[level] += delta
+            if not name:
+                break
+            if not any(counts):
+                del rollup[name]
+            name = name.rpartition('/')[0].strip()
+
+    def get_rollup_level(self, name):
+        """
+        Aggregate level of the subtree rooted at C{name}: ERROR or WARN if any
+        item below it has that level, otherwise STALE if any item is stale.
+        @rtype: C{int}
+        """
+        counts = self._rollup.get(name)
+        if counts is None:
+            return DiagnosticStatus.STALE
+        if counts[DiagnosticStatus.ERROR]:
+            return DiagnosticStatus.ERROR
+        elif counts[DiagnosticStatus.WARN]:
+            return DiagnosticStatus.WARN
+        elif counts[DiagnosticStatus.STALE] or not counts[DiagnosticStatus.OK]:
+            return DiagnosticStatus.STALE
+        return DiagnosticStatus.OK
+
+    def get_rollup_color(self, name):
+        return self.COLORS[self.get_rollup_level(name)]
+
+    def _index_item(self, item):
+        """
+        Insert a newly seen item into the sorted name, child and level
+        indices, the severity buckets and the subtree counts.
+        """
+        self._allocate_slot(item)
+        bisect.insort(self.diagnostics_display, item.name)
+        bisect.insort(self._children.setdefault(item.parent_name, []),
+                      item.name)
+        bisect.insort(self._levels.setdefault(item.level, []), item.name)
+        self._severity[item.status].add(item.name)
+        self._adjust_rollup(item.name, item.status, 1)
+
+    def _unindex_item(self, item):
+        """
+        Remove an item from the sorted name, child and level indices, the
+        severity buckets and the subtree counts.
+        """
+        for names in (self.diagnostics_display,
+                      self._children[item.parent_name],
+                      self._levels[item.level]):
+            del names[bisect.bisect_left(names, item.name)]
+        self._severity[item.status].discard(item.name)
+        self._adjust_rollup(item.name, item.status, -1)
+        self._free_slot(item)
+
+    @property
+    def version(self):
+        """
+        Version of everything shown in display lists: the set of names and
+        the level of every item
+        @type: C{tuple}
+        """
+        return (self.structure_version, self.level_version)
+
+    def get_children(self, parent):
+        """
+        Sorted names of the direct children of C{parent}.
+        @rtype: C{list}
+        """
+        return self._children.get(parent, [])
 
     def get_number_children(self, parent):
-        children = 0
-        for item in self.diagnostics_data.itervalues():
-            if item.get_parent_name() == parent:
-                children += 1
-        return children
+        return len(self._children.get(parent, ()))
 
     def get_length(self):
         return len(self.diagnostics_data)
 
+    @property
+    def system_status(self):
+        """
+        Worst level of all items that are not stale
+        @type: C{int}
+        """
+        counts = self._rollup['']
+        if counts[DiagnosticStatus.ERROR]:
+            return DiagnosticStatus.ERROR
+        elif counts[DiagnosticStatus.WARN]:
+            return DiagnosticStatus.WARN
+        return DiagnosticStatus.OK
+
     def get_system_status(self):
         return self.COLORS[self.system_status]
 
+    def _display_entries(self, names):
+        data = self.diagnostics_data
+        display_list = []
+        for name in names:
+            display_list.append((name, data[name].nice_name,
+                                 self.get_rollup_color(name)))
+        return display_list
+
     def get_display_list(self, root=None, display_level=None):
+        """
+        Get the (name, nice name, color) entries for a view of the database.
+        
+        Results are cached until the database L{version} changes and shared
+        between all callers, so the returned list must not be modified.
+        @rtype: C{list}
+        """
+        key = (root, display_level)
+        cache = self._get_render_cache()
+        if key not in cache:
+            cache[key] = self._build_display_list(root, display_level)
+        return cache[key]
+
+    def get_filtered_list(self, prefix=None, levels=None):
+        """
+        Get the (name, name, color) entries of all items whose name starts
+        with C{prefix} and whose own level is in C{levels}, sorted by name.
+        
+        Candidates come from whichever of the prefix range or the severity
+        buckets is smaller, so the cost follows the size of the answer
+        rather than the size of the database.  Results are cached like
+        L{get_display_list}.
+        @param prefix: Name prefix, or None for any name
+        @type prefix: C{string}
+        @param levels: Levels to include, or None for any level
+        @type levels: C{frozenset}
+        @rtype: C{list}
+        """
+        key = ('filter', prefix, levels)
+        cache = self._get_render_cache()
+        if key in cache:
+            return cache[key]
+        data = self.diagnostics_data
+        if prefix:
+            names = self.diagnostics_display
+            lo = bisect.bisect_left(names, prefix)
+            hi = bisect.bisect_left(names, prefix + '\xff')
+        if levels is not None:
+            size = sum(len(self._severity[level]) for level in levels)
+        if prefix and (levels is None or hi - lo <= size):
+            names = names[lo:hi]
+            if levels is not None:
+                names = [name for name in names if data[name].status in levels]
+        elif levels is not None:
+            names = []
+            for level in levels:
+                names.extend(self._severity[level])
+            if prefix:
+                names = [name for name in names if name.startswith(prefix)]
+            names.sort()
+        else:
+            names = self.diagnostics_display
+        cache[key] = [(name, name.lstrip('/'), data[name].get_color())
+                      for name in names]
+        return cache[key]
+
+    def get_display_window(self, root, display_level, offset, length,
+                           prefix=None, levels=None):
+        """
+        Get the C{length} display entries starting at C{offset} of a view.
+        If C{prefix} or C{levels} is given, the view is the filtered list from
+        L{get_filtered_list} instead of the tree view.
+        
+        Windows are cached by (database version, topic, root, display level,
+        filter, offset, length), so clients looking at the same part of the
+        same view share a single render.
+        @rtype: C{tuple}
+        """
+        key = (self.version, self.topic, root, display_level, prefix, levels,
+               offset, length)
+        cache = self._get_render_cache()
+        if key not in cache:
+            if prefix or levels is not None:
+                display_list = self.get_filtered_list(prefix, levels)
+            else:
+                display_list = self.get_display_list(root=root,
+                                                     display_level=display_level)
+            cache[key] = tuple(display_list[offset:offset + length])
+        return cache[key]
+
+    def _get_render_cache(self):
+        if self._render_cache_version != self.version:
+            self._render_cache = {}
+            self._render_cache_version = self.version
+        return self._render_cache
+
+    def _build_display_list(self, root, display_level):
         if display_level and root:
-            messages = [self.diagnostics_data[x] for x in self.diagnostics_display]
-            display_list = []
             rootNode = self.diagnostics_data[root]
-            display_list.append((rootNode.name, rootNode.get_nice_name(), rootNode.get_color()))
-            for msg in messages:
-                if msg.get_parent_name() == root:
-                    display_list.append((msg.name, msg.get_nice_name(), msg.get_color()))
+            display_list = [(rootNode.name, rootNode.nice_name,
+                             self.get_rollup_color(root))]
+            display_list.extend(self._display_entries(self.get_children(root)))
             return display_list
         if display_level and not root:
-            messages = [self.diagnostics_data[x] for x in self.diagnostics_display]
-            display_list = []
-            for msg in messages:
-                if msg.get_level() == display_level:
-                    display_list.append((msg.name, msg.get_nice_name(), msg.get_color()))
-            return display_list
+            return self._display_entries(self._levels.get(display_level, []))
         else:
-            messages = [self.diagnostics_data[x] for x in self.diagnostics_display]
-            return [(msg.name, msg.get_nice_name(), msg.get_color()) for msg in messages]
+            return self._display_entries(self.diagnostics_display)
 
 class DiagnosticsTabpageHandler(AbstractTabpageHandler):
+    """
+    Tabpage handler that browses /diagnostics and /diagnostics_agg.
+    
+    Two optional controls filter the list of items:
+    
+      - C{dfilter}: a multitoggle with four toggles in one row or column,
+        selecting OK, WARN, ERROR and STALE items.  The iPad layout shipped
+        with this package has it below the item details; the iPod layout has
+        no room for it.
+      - C{dprefix}: an address receiving a single string argument with a
+        name prefix to show.  TouchOSC cannot send strings, so this is meant
+        for other OSC clients and scripts.
+    """
     def __init__(self, touchosc_interface, handler_name, tabpage_names):
         super(DiagnosticsTabpageHandler, self).__init__(touchosc_interface,
                                                         handler_name,
@@ -395,39 +1050,139 @@ class DiagnosticsTabpageHandler(AbstractTabpageHandler):
                               z_callback=self.fallback)
         self.add_osc_callback('kvfader', self.kv_updown_cb,
                               z_callback=self.fallback)
+        self.add_osc_callback('dfilter', self.dfilter_cb,
+                              z_callback=self.fallback)
+        self.add_osc_callback('dprefix', self.dprefix_cb)
         self.osc_clients = {}
-        self.diagnostics_data = DiagnosticsData("/diagnostics")
-        self.diagnostics_agg_data = DiagnosticsData("/diagnostics_agg")
+        pref = "~" + self.handler_name + "/"
+        self.refresh_rate = rospy.get_param(pref + "refresh_rate", 2.0)
+        if self.refresh_rate <= 0:
+            rospy.logwarn("%srefresh_rate must be positive, got %s, using 2.0" %
+                          (pref, self.refresh_rate))
+            self.refresh_rate = 2.0
+        stale_timeout = rospy.get_param(pref + "stale_timeout", 5.0)
+        expire_timeout = rospy.get_param(pref + "expire_timeout", 300.0)
+        max_items = rospy.get_param(pref + "max_items", 50000)
+        history_length = rospy.get_param(pref + "history_length", 16)
+        log_length = rospy.get_param(pref + "log_length", 4096)
+        self.unsubscribe_linger = rospy.get_param(pref + "unsubscribe_linger",
+                                                  10.0)
+        self.diagnostics_data = DiagnosticsData("/diagnostics",
+                                                stale_timeout,
+                                                expire_timeout,
+                                                max_items,
+                                                history_length,
+                                                log_length)
+        self.diagnostics_agg_data = DiagnosticsData("/diagnostics_agg",
+                                                    stale_timeout,
+                                                    expire_timeout,
+                                                    max_items,
+                                                    history_length,
+                                                    log_length)
+        self.diagnostics_sub = None
+        self.diagnostics_agg_sub = None
+        self._refresh_call = None
+        self._unsubscribe_call = None
 
-    def initialize_tabpage(self):
-        self.diagnostics_sub = rospy.Subscriber("diagnostics",
-                                                DiagnosticArray,
-                                                self.diag_cb)
-        self.diagnostics_agg_sub = rospy.Subscriber("diagnostics_agg",
-                                                    DiagnosticArray,
-                                                    self.diag_agg_cb)
+    def _update_subscriptions(self):
+        """
+        Subscribe to the diagnostics topics while any client is watching the
+        tabpage, and schedule the subscriptions to be dropped once the last
+        client has left it for C{unsubscribe_linger} seconds.
+        
+        The databases are kept across subscriptions, so a returning client
+        sees the last known state (greyed out where it has gone stale) while
+        fresh messages, or the latched snapshot of a latched publisher,
+        arrive.
+        """
+        watching = False
+        for client in self.osc_clients.itervalues():
+            if client.active:
+                watching = True
+                break
+        if watching:
+            if self._unsubscribe_call and self._unsubscribe_call.active():
+                self._unsubscribe_call.cancel()
+            self._unsubscribe_call = None
+            if self.diagnostics_sub is None:
+                self.diagnostics_sub = rospy.Subscriber("diagnostics",
+                                                        DiagnosticArray,
+                                                        self.diag_cb)
+                self.diagnostics_agg_sub = rospy.Subscriber("diagnostics_agg",
+                                                            DiagnosticArray,
+                                                            self.diag_agg_cb)
+            if self._refresh_call is None or not self._refresh_call.active():
+                self._refresh_call = reactor.callLater(1.0 / self.refresh_rate,
+                                                       self.refresh_cb)
+        elif self.diagnostics_sub is not None and self._unsubscribe_call is None:
+            self._unsubscribe_call = reactor.callLater(self.unsubscribe_linger,
+                                                       self.unsubscribe_cb)
 
-    def diag_agg_cb(self, msg):
-        self.diagnostics_agg_data.add_message(msg)
-        for addr, client in self.osc_clients.iteritems():
+    def unsubscribe_cb(self):
+        """
+        Drop the diagnostics subscriptions after the linger period, unless a
+        client has come back in the meantime.
+        """
+        self._unsubscribe_call = None
+        for client in self.osc_clients.itervalues():
             if client.active:
-                to_display = client.update_diagnostics_display(fader=True)
-                to_display.extend(client.update_detail_display(fader=True))
-                self.send(osc.Bundle(to_display), clients=[addr])
-        self.send(osc.Message("rostime", str(rospy.Time.now().to_sec())))
+                return
+        if self.diagnostics_sub is not None:
+            self.diagnostics_sub.unregister()
+            self.diagnostics_agg_sub.unregister()
+            self.diagnostics_sub = None
+            self.diagnostics_agg_sub = None
+
+    def diag_agg_cb(self, msg):
+        reactor.callFromThread(self.diagnostics_agg_data.add_message, msg)
 
     def diag_cb(self, msg):
-        self.diagnostics_data.add_message(msg)
-        for addr, client in self.osc_clients.iteritems():
-            if client.active:
-                to_display = client.update_diagnostics_display(fader=True)
-                to_display.extend(client.update_detail_display(fader=True))
-                self.send(osc.Bundle(to_display), clients=[addr])
-        self.send(osc.Message("rostime", str(rospy.Time.now().to_sec())))
+        reactor.callFromThread(self.diagnostics_data.add_message, msg)
+
+    def refresh_cb(self):
+        """
+        Periodic refresh of all active clients.
+        
+        Incoming DiagnosticArrays only mark their database dirty; each active
+        client viewing a dirty database is redrawn at most once per tick.
+        Items that have stopped updating are greyed out and expired here.
+        The refresh stops once the diagnostics topics are unsubscribed.
+        """
+        try:
+            self.diagnostics_data.expire()
+            self.diagnostics_agg_data.expire()
+            bundles = {}
+            for addr, client in self.osc_clients.iteritems():
+                if client.active and client.diag_db.dirty:
+                    to_display = client.update_diagnostics_display(fader=True)
+                    to_display.extend(client.update_detail_display(fader=True))
+                    if not to_display:
+                        continue
+                    key = tuple((m.address, tuple(m.getValues()))
+                                for m in to_display)
+                    if key in bundles:
+                        bundles[key][1].append(addr)
+                    else:
+                        bundles[key] = (to_display, [addr])
+            # Clients with identical updates share one encoded bundle
+            for (to_display, addrs) in bundles.itervalues():
+                self.send(osc.Bundle(to_display), clients=addrs)
+            if self.diagnostics_data.dirty or self.diagnostics_agg_data.dirty:
+                self.send(osc.Message("rostime",
+                                      str(rospy.Time.now().to_sec())))
+            self.diagnostics_data.dirty = False
+            self.diagnostics_agg_data.dirty = False
+        finally:
+            # Keep ticking even if one refresh fails
+            if self.diagnostics_sub is not None:
+                self._refresh_call = reactor.callLater(1.0 / self.refresh_rate,
+                                                       self.refresh_cb)
+            else:
+                self._refresh_call = None
 
     def diagsw_cb(self, address_list, value_list, send_address):
         if not self.osc_clients.has_key(send_address[0]):
-            self.cb_client_connected(send_address[0])
+            self.cb_tabpage_active(send_address[0], address_list[0])
         if value_list[0] == 0.0:
             client = self.osc_clients[send_address[0]]
             to_display = client.clear_display()
@@ -489,12 +1244,65 @@ class DiagnosticsTabpageHandler(AbstractTabpageHandler):
         except:
             return
         if len(address_list) == 4:
+            level_filtered = client.filter_levels is not None
             client.set_detailed_display(int(address_list[3]) - 1)
             client.detail_offset = 0
             to_display = client.update_diagnostics_display(fader=True)
             to_display.extend(client.update_detail_display(fader=True))
+            if level_filtered and client.filter_levels is None:
+                # Back in the tree; the filter toggles are still lit
+                to_display.extend(client.clear_filter_display())
             self.send(osc.Bundle(to_display), clients=[send_address[0]])
 
+    def dfilter_cb(self, address_list, value_list, send_address):
+        """
+        Callback for the severity filter multitoggle.
+        
+        The four toggles (in a single row or column) select OK, WARN, ERROR
+        and STALE items.  With no toggle set the list shows the normal tree.
+        
+        @param address_list: OSC address of the incoming message
+        @param value_list: OSC value arguments of the incoming message
+        @param send_address: IP and port of the originating client
+        """
+        try:
+            client = self.osc_clients[send_address[0]]
+        except KeyError:
+            return
+        if len(address_list) != 4:
+            return
+        level = int(address_list[2]) + int(address_list[3]) - 2
+        if not DiagnosticsData.COLORS.has_key(level):
+            return
+        levels = set(client.filter_levels or ())
+        if value_list[0] > 0.5:
+            levels.add(level)
+        else:
+            levels.discard(level)
+        client.set_filter(client.filter_prefix, frozenset(levels))
+        to_display = client.update_diagnostics_display(fader=True)
+        self.send(osc.Bundle(to_display), clients=[send_address[0]])
+
+    def dprefix_cb(self, address_list, value_list, send_address):
+        """
+        Callback for a name prefix search string.  An empty string clears the
+        prefix filter.
+        
+        @param address_list: OSC address of the incoming message
+        @param value_list: OSC value arguments of the incoming message
+        @param send_address: IP and port of the originating client
+        """
+        try:
+            client = self.osc_clients[send_address[0]]
+        except KeyError:
+            return
+        prefix = str(value_list[0]).strip() if value_list else ''
+        if prefix and not prefix.startswith('/'):
+            prefix = '/' + prefix
+        client.set_filter(prefix, client.filter_levels)
+        to_display = client.update_diagnostics_display(fader=True)
+        self.send(osc.Bundle(to_display), clients=[send_address[0]])
+
     def cb_diagnostics_update(self):
         tabpage_status = DiagnosticStatus()
         tabpage_status.level = tabpage_status.OK
@@ -512,8 +1320,11 @@ class DiagnosticsTabpageHandler(AbstractTabpageHandler):
         """
         if self.osc_clients.has_key(client):
             self.osc_clients[client].active = True
+            self.osc_clients[client].invalidate_display()
         else:
-            self.cb_client_connected(client)
+            self._add_client(client)
+            self.osc_clients[client].active = True
+        self._update_subscriptions()
         self.send(osc.Message("diaglbl", self.osc_clients[client].topic),
                   clients=[client])
 
@@ -525,15 +1336,35 @@ class DiagnosticsTabpageHandler(AbstractTabpageHandler):
         if self.osc_clients.has_key(client):
             self.osc_clients[client].active = False
         else:
-            self.cb_client_connected(client)
+            self._add_client(client)
             self.osc_clients[client].active = False
+        self._update_subscriptions()
 
     def cb_client_connected(self, client):
         """
         Callback for when a client has connected.
         
+        Called from the Bonjour thread, so the client is added on the reactor
+        thread where C{osc_clients} is iterated.
+        """
+        reactor.callFromThread(self._add_client, client)
+
+    def cb_client_disconnected(self, client):
+        """
+        Callback for when a client has disconnected.
+        
+        Called from the Bonjour thread, so the client is removed on the
+        reactor thread where C{osc_clients} is iterated.
+        """
+        reactor.callFromThread(self._remove_client, client)
+
+    def _add_client(self, client):
+        """
         Add the client to the local dictionary of clients and initialize it.
         """
+        if not self.parent.clients.has_key(client):
+            # Disconnected again before this call ran
+            return
         parent_client = self.parent.clients[client]
         self.osc_clients[client] = DiagnosticsClient(parent_client.servicename,
                                                      parent_client.client_type,
@@ -548,14 +1379,15 @@ class DiagnosticsTabpageHandler(AbstractTabpageHandler):
         to_display.extend(self.osc_clients[client].clear_display())
         to_display.append(osc.Message("diaglbl", self.osc_clients[client].topic))
         self.send(osc.Bundle(to_display), clients=[client])
-        self.osc_clients[client].active = True
+        # Only clients already showing this tabpage count as watching
+        self.osc_clients[client].active = (parent_client.active_tabpage in
+                                           self.tabpage_names)
+        self._update_subscriptions()
 
-    def cb_client_disconnected(self, client):
+    def _remove_client(self, client):
         """
-        Callback for when a client has disconnected.
-        
-        Remove the client from the local dictionary of clients
+        Remove the client from the local dictionary of clients.
         """
         if self.osc_clients.has_key(client):
             del self.osc_clients[client]
-
+            self._update_subscriptions()
@@ -5,9 +5,22 @@ import rospy
 import time
 
 from diagnostics_handler.diagnosticstabpage import DiagnosticsClient, DiagnosticsItem
+from diagnostics_handler.diagnosticstabpage import DiagnosticsData
 from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 
 
+def make_array(statuses):
+    """
+    Build a DiagnosticArray with one status per (name, level) pair.
+    """
+    msg = DiagnosticArray()
+    msg.header.stamp = rospy.Time.from_sec(time.time())
+    msg.status = [DiagnosticStatus(level=level, name=name, message="OK",
+                                   hardware_id="Python Unittest", values=[])
+                  for (name, level) in statuses]
+    return msg
+
+
 class Test_DiagnosticsClient(unittest.TestCase):
     def setUp(self):
         self.dc = DiagnosticsClient("Michaels iPhone", "ipod", "/diagnostics")
@@ -83,6 +96,26 @@ class Test_DiagnosticsItem(unittest.TestCase):
         self.assertEqual([('Key 1', 'Value 1'), ('Key 2', 'Value 2')],
                          disp)
 
+    def test_update_unchanged(self):
+        msg = DiagnosticsItem(self.status.name)
+        self.assertTrue(msg.update(self.stamp, self.status))
+        self.assertFalse(msg.update(self.stamp, self.status))
+        self.status.values[1] = KeyValue("Key 2", "Value 3")
+        self.assertTrue(msg.update(self.stamp, self.status))
+        self.assertEqual([('Key 1', 'Value 1'), ('Key 2', 'Value 3')],
+                         msg.get_display_list())
+
+    def test_update_fewer_values(self):
+        msg = DiagnosticsItem(self.status.name)
+        msg.update(self.stamp, self.status)
+        del self.status.values[0]
+        msg.update(self.stamp, self.status)
+        self.assertEqual(msg.get_length(), 1)
+        self.assertEqual([('Key 2', 'Value 2')], msg.get_display_list())
+
+    def test_get_level(self):
+        self.assertEqual(DiagnosticsItem("/Other/TouchOSC").get_level(), 2)
+
     def test_get_parent_name(self):
         msg = DiagnosticsItem("/Other/TouchOSC/Status Message")
         self.assertEqual("/Other/TouchOSC", msg.get_parent_name())
@@ -98,5 +131,272 @@ class Test_DiagnosticsItem(unittest.TestCase):
         self.assertEqual('', msg.get_parent_name())
         self.assertEqual("Status Message", msg.get_nice_name())
 
+class Test_DiagnosticsData(unittest.TestCase):
+    def setUp(self):
+        self.db = DiagnosticsData("/diagnostics_agg")
+        self.db.add_message(make_array([("/Robot", 0),
+                                        ("/Robot/Sensors", 1),
+                                        ("/Robot/Motors", 0),
+                                        ("/Robot/Sensors/Lidar", 1),
+                                        ("/Other", 2)]))
+
+    def test_length(self):
+        self.assertEqual(self.db.get_length(), 5)
+
+    def test_number_children(self):
+        self.assertEqual(self.db.get_number_children("/Robot"), 2)
+        self.assertEqual(self.db.get_number_children("/Robot/Sensors"), 1)
+        self.assertEqual(self.db.get_number_children("/Other"), 0)
+
+    def test_display_level(self):
+        disp = self.db.get_display_list(display_level=1)
+        self.assertEqual([name for (name, _, _) in disp], ["/Other", "/Robot"])
+
+    def test_display_root(self):
+        disp = self.db.get_display_list(root="/Robot", display_level=2)
+        self.assertEqual(disp, [("/Robot", "Robot", "yellow"),
+                                ("/Robot/Motors", "Motors", "green"),
+                                ("/Robot/Sensors", "Sensors", "yellow")])
+
+    def test_display_all(self):
+        disp = self.db.get_display_list()
+        self.assertEqual([name for (name, _, _) in disp],
+                         sorted(self.db.diagnostics_data.keys()))
+
+    def test_insert_keeps_order(self):
+        self.db.add_message(make_array([("/Robot/Arm", 0),
+                                        ("/Robot/Sensors", 0)]))
+        disp = self.db.get_display_list(root="/Robot", display_level=2)
+        self.assertEqual([name for (name, _, _) in disp],
+                         ["/Robot", "/Robot/Arm", "/Robot/Motors",
+                          "/Robot/Sensors"])
+        self.assertEqual(self.db.get_length(), 6)
+
+    def test_rollup(self):
+        self.assertEqual(self.db.get_rollup_color("/Robot"), "yellow")
+        self.assertEqual(self.db.get_rollup_color("/Robot/Motors"), "green")
+        self.assertEqual(self.db.get_system_status(), "red")
+        self.db.add_message(make_array([("/Robot/Sensors/Lidar", 2)]))
+        self.assertEqual(self.db.get_rollup_color("/Robot"), "red")
+        self.db.add_message(make_array([("/Robot/Sensors/Lidar", 0),
+                                        ("/Robot/Sensors", 0),
+                                        ("/Other", 0)]))
+        self.assertEqual(self.db.get_rollup_color("/Robot"), "green")
+        self.assertEqual(self.db.get_system_status(), "green")
+
+    def test_display_window_shared(self):
+        window = self.db.get_display_window("/Robot", 2, 1, 10)
+        self.assertEqual([name for (name, _, _) in window],
+                         ["/Robot/Motors", "/Robot/Sensors"])
+        self.assertIs(window, self.db.get_display_window("/Robot", 2, 1, 10))
+        self.db.add_message(make_array([("/Robot/Arm", 0)]))
+        window = self.db.get_display_window("/Robot", 2, 1, 10)
+        self.assertEqual([name for (name, _, _) in window],
+                         ["/Robot/Arm", "/Robot/Motors", "/Robot/Sensors"])
+
+    def test_dirty(self):
+        self.assertTrue(self.db.dirty)
+        self.db.dirty = False
+        self.db.add_message(make_array([("/Other", 0)]))
+        self.assertTrue(self.db.dirty)
+
+    def test_filter_prefix(self):
+        disp = self.db.get_filtered_list(prefix="/Robot/S")
+        self.assertEqual(disp, [("/Robot/Sensors", "Robot/Sensors", "yellow"),
+                                ("/Robot/Sensors/Lidar", "Robot/Sensors/Lidar",
+                                 "yellow")])
+        self.assertEqual(self.db.get_filtered_list(prefix="/Nothing"), [])
+
+    def test_filter_levels(self):
+        disp = self.db.get_filtered_list(levels=frozenset([1, 2]))
+        self.assertEqual([name for (name, _, _) in disp],
+                         ["/Other", "/Robot/Sensors", "/Robot/Sensors/Lidar"])
+        self.db.add_message(make_array([("/Robot/Sensors/Lidar", 0)]))
+        disp = self.db.get_filtered_list(levels=frozenset([1, 2]))
+        self.assertEqual([name for (name, _, _) in disp],
+                         ["/Other", "/Robot/Sensors"])
+
+    def test_filter_prefix_and_levels(self):
+        disp = self.db.get_filtered_list(prefix="/Robot",
+                                         levels=frozenset([0]))
+        self.assertEqual([name for (name, _, _) in disp],
+                         ["/Robot", "/Robot/Motors"])
+        window = self.db.get_display_window(None, 1, 1, 10, "/Robot",
+                                            frozenset([0]))
+        self.assertEqual([name for (name, _, _) in window], ["/Robot/Motors"])
+
+    def test_client_filter(self):
+        dc = DiagnosticsClient("Michaels iPhone", "ipod", "/diagnostics_agg")
+        dc.diag_db = self.db
+        dc.update_diagnostics_display()
+        dc.set_filter(levels=frozenset([1]))
+        self.assertTrue(dc.filtered)
+        dc.update_diagnostics_display()
+        self.assertEqual([name for (name, _, _) in dc.display_list],
+                         ["/Robot/Sensors", "/Robot/Sensors/Lidar"])
+        # Tapping an item twice jumps to it in the tree
+        dc.set_detailed_display(0)
+        dc.set_detailed_display(0)
+        self.assertFalse(dc.filtered)
+        self.assertEqual(dc.expanded_display.name, "/Robot/Sensors")
+        dc.update_diagnostics_display()
+        self.assertEqual([name for (name, _, _) in dc.display_list],
+                         ["/Robot/Sensors", "/Robot/Sensors/Lidar"])
+
+    def test_clear_filter_display(self):
+        dc = DiagnosticsClient("Michaels iPhone", "ipad", "/diagnostics_agg")
+        dc.diag_db = self.db
+        to_display = dc.clear_filter_display()
+        self.assertEqual(set(m.address for m in to_display),
+                         set(["dfilter/1/1", "dfilter/1/2", "dfilter/1/3",
+                              "dfilter/1/4", "dfilter/2/1", "dfilter/3/1",
+                              "dfilter/4/1"]))
+        self.assertEqual(set(tuple(m.getValues()) for m in to_display),
+                         set([(0.0,)]))
+        addresses = [m.address for m in dc.clear_display()]
+        self.assertTrue("dfilter/1/1" in addresses)
+
+class Test_DiagnosticsClientRendering(unittest.TestCase):
+    def row_addresses(self, to_display):
+        return [m.address for m in to_display
+                if m.address.startswith("dled") or m.address.startswith("dlabel")]
+
+    def setUp(self):
+        self.db = DiagnosticsData("/diagnostics")
+        self.db.add_message(make_array([("/Item %02i" % i, 0)
+                                        for i in range(12)]))
+        self.dc = DiagnosticsClient("Michaels iPhone", "ipod", "/diagnostics")
+        self.dc.diag_db = self.db
+
+    def test_first_render_sends_all_rows(self):
+        to_display = self.dc.update_diagnostics_display()
+        self.assertEqual(len(self.row_addresses(to_display)), 10 * 4)
+
+    def test_unchanged_render_sends_no_rows(self):
+        self.dc.update_diagnostics_display()
+        to_display = self.dc.update_diagnostics_display()
+        self.assertEqual(self.row_addresses(to_display), [])
+
+    def test_changed_level_sends_led_color(self):
+        self.dc.update_diagnostics_display()
+        self.db.add_message(make_array([("/Item 03", 2)]))
+        to_display = self.dc.update_diagnostics_display()
+        self.assertEqual(self.row_addresses(to_display), ["dled4/color"])
+
+    def test_scroll_sends_shifted_labels(self):
+        self.dc.update_diagnostics_display()
+        self.dc.diagnostics_offset += 1
+        to_display = self.dc.update_diagnostics_display()
+        self.assertEqual(self.row_addresses(to_display),
+                         ["dlabel%i" % i for i in range(1, 11)])
+
+    def test_untouched_detail_skipped(self):
+        self.dc.update_diagnostics_display()
+        self.dc.set_detailed_display(0)
+        self.assertNotEqual(self.dc.update_detail_display(), [])
+        self.assertNotEqual(self.dc.update_diagnostics_display(), [])
+        self.db.add_message(make_array([("/Item 05", 0)]))
+        self.assertEqual(self.dc.update_detail_display(), [])
+        self.assertEqual(self.dc.update_diagnostics_display(), [])
+        self.db.add_message(make_array([("/Item 00", 1)]))
+        self.assertNotEqual(self.dc.update_detail_display(), [])
+
+    def test_invalidate_resends_rows(self):
+        self.dc.update_diagnostics_display()
+        self.dc.invalidate_display()
+        to_display = self.dc.update_diagnostics_display()
+        self.assertEqual(len(self.row_addresses(to_display)), 10 * 4)
+
+class Test_DiagnosticsDataExpiry(unittest.TestCase):
+    def setUp(self):
+        self.db = DiagnosticsData("/diagnostics", stale_timeout=5.0,
+                                  expire_timeout=60.0, max_items=3)
+        self.db.add_message(make_array([("/A", 0), ("/B", 2)]), now=0.0)
+        self.db.add_message(make_array([("/A", 0)]), now=4.0)
+
+    def test_stale(self):
+        self.assertFalse(self.db.expire(now=4.0))
+        self.assertTrue(self.db.expire(now=6.0))
+        self.assertEqual(self.db.diagnostics_data["/B"].get_color(), "gray")
+        self.assertEqual(self.db.diagnostics_data["/A"].get_color(), "green")
+
+    def test_system_status_recovers(self):
+        self.assertEqual(self.db.get_system_status(), "red")
+        self.db.expire(now=6.0)
+        self.assertEqual(self.db.get_system_status(), "green")
+
+    def test_expire(self):
+        self.db.expire(now=6.0)
+        self.db.expire(now=61.0)
+        self.assertEqual(sorted(self.db.diagnostics_data.keys()), ["/A"])
+        self.assertEqual(self.db.get_display_list(display_level=1),
+                         [("/A", "A", "gray")])
+
+    def test_update_unstales(self):
+        self.db.expire(now=6.0)
+        self.db.add_message(make_array([("/B", 1)]), now=7.0)
+        self.assertEqual(self.db.get_system_status(), "yellow")
+        self.db.expire(now=65.0)
+        self.assertEqual(sorted(self.db.diagnostics_data.keys()), ["/B"])
+
+    def test_max_items(self):
+        self.db.add_message(make_array([("/C", 0), ("/D", 0)]), now=5.0)
+        self.assertEqual(sorted(self.db.diagnostics_data.keys()),
+                         ["/A", "/C", "/D"])
+        self.assertEqual(self.db.get_system_status(), "green")
+
+    def test_history(self):
+        self.db.expire(now=6.0)
+        self.db.add_message(make_array([("/B", 1)]), now=7.0)
+        self.assertEqual(self.db.get_history("/B"),
+                         [(0.0, 2), (6.0, 3), (7.0, 1)])
+        self.assertEqual(self.db.get_flap_count("/B"), 2)
+        self.assertEqual(self.db.get_time_in_state("/B", now=10.0), 3.0)
+        self.assertEqual(self.db.get_flap_count("/A"), 0)
+
+    def test_history_ring(self):
+        db = DiagnosticsData("/diagnostics", history_length=2)
+        for (now, level) in [(0.0, 0), (1.0, 1), (2.0, 0), (3.0, 2)]:
+            db.add_message(make_array([("/A", level)]), now=now)
+        self.assertEqual(db.get_history("/A"), [(2.0, 0), (3.0, 2)])
+        self.assertEqual(db.get_flap_count("/A"), 3)
+
+    def test_changes(self):
+        self.db.expire(now=6.0)
+        self.db.add_message(make_array([("/B", 1)]), now=7.0)
+        self.assertEqual(self.db.get_changes(2.0, now=7.0),
+                         [("/B", 7.0, 1), ("/B", 6.0, 3)])
+        # Changes of removed items are not reported
+        self.db.add_message(make_array([("/C", 0), ("/D", 0)]), now=8.0)
+        self.db.add_message(make_array([("/E", 0)]), now=9.0)
+        self.assertEqual(self.db.get_changes(2.0, now=9.0),
+                         [("/E", 9.0, 0), ("/D", 8.0, 0), ("/C", 8.0, 0)])
+
+    def test_detail_history(self):
+        dc = DiagnosticsClient("Michaels iPhone", "ipod", "/diagnostics")
+        dc.diag_db = self.db
+        dc.detail_display = self.db.diagnostics_data["/B"]
+        self.db.expire(now=6.0)
+        self.db.expire(now=9.0)
+        self.assertEqual(dc.get_detail_list(), [("Level changes", "1"),
+                                                ("Time in state", "< 1 min")])
+        self.assertEqual(dc.get_max_detail_offset(), 0)
+
+    def test_detail_key_stable(self):
+        db = DiagnosticsData("/diagnostics", stale_timeout=5.0,
+                             expire_timeout=600.0)
+        db.add_message(make_array([("/A", 0)]), now=0.0)
+        dc = DiagnosticsClient("Michaels iPhone", "ipod", "/diagnostics")
+        dc.diag_db = db
+        dc.detail_display = db.diagnostics_data["/A"]
+        db.expire(now=6.0)
+        self.assertNotEqual(dc.update_detail_display(), [])
+        # Seconds passing within the same minute do not redraw the rows
+        db.expire(now=30.0)
+        self.assertEqual(dc.update_detail_display(), [])
+        db.expire(now=70.0)
+        self.assertIn(["1 min"], [m.getValues()
+                                  for m in dc.update_detail_display()])
+
 if __name__ == "__main__":
     unittest.main()
@@ -97,13 +97,65 @@ class OscClient(object):
         return self._port
 
 
+class TimestampedDatagramServerProtocol(async.DatagramServerProtocol):
+    """
+    A DatagramServerProtocol that records the time each datagram arrived
+    before it is dispatched.
+    
+    The time is taken when Twisted hands the datagram to the protocol, which
+    is as close to arrival as the reactor allows.  Callbacks run
+    synchronously during dispatch, so they can read it from
+    L{RosOscReceiver.arrival_stamp}.
+    """
+    def datagramReceived(self, data, address):
+        self._receiver.arrival_stamp = rospy.Time.now()
+        async.DatagramServerProtocol.datagramReceived(self, data, address)
+
+
 class RosOscReceiver(dispatch.Receiver):
     """
     A class to override the default behavior of dispatch.Receiver from txosc.
     
     This will call callbacks with the signature:
     C{callback(addressList, valuesList, clientAddress)}
+    
+    Callbacks for fixed addresses may also be added with
+    L{addDirectCallback}.  These are found with a single dictionary lookup
+    before any pattern matching, and are called with the signature:
+    C{callback(index, valuesList, clientAddress)}
+    
+    Messages to an address in the schema added with L{addSchema} are only
+    dispatched if their type tags match the schema exactly.  Others are
+    dropped before any callback runs and counted in C{rejected}.
     """
+    def __init__(self):
+        dispatch.Receiver.__init__(self)
+        self.direct_callbacks = {}
+        self.schema = {}
+        self.rejected = 0
+        self.arrival_stamp = None
+
+    def addDirectCallback(self, address, callback, index=None):
+        """
+        Add a callback for a single, fully specified address.
+        
+        @param address: Full OSC address, such as C{/1/multipush/3/4}
+        @type address: C{str}
+        @param callback: Function called with C{(index, values, client)}
+        @param index: Value passed to the callback as its first argument
+        """
+        self.direct_callbacks[address] = (callback, index)
+
+    def addSchema(self, schema):
+        """
+        Add expected argument type tags for fully specified addresses.
+        
+        @param schema: Full OSC address -> type tag string, such as
+        C{{'/1/xy1': 'ff'}}
+        @type schema: C{dict}
+        """
+        self.schema.update(schema)
+
     def dispatch(self, element, client):
         """
         Dispatch an element to all matching callbacks.
@@ -118,7 +170,19 @@ class RosOscReceiver(dispatch.Receiver):
             messages = element.getMessages()
         else:
             messages = [element]
+        schema = self.schema
         for msg in messages:
+            typetags = schema.get(msg.address)
+            if typetags is not None and msg.getTypeTags() != typetags:
+                self.rejected += 1
+                rospy.logdebug("Rejected %s %s from %s, expected %s" %
+                               (msg.address, msg.getTypeTags(), client[0],
+                                typetags))
+                continue
+            direct = self.direct_callbacks.get(msg.address)
+            if direct is not None:
+                direct[0](direct[1], msg.getValues(), client)
+                continue
             matched = False
             address_list = osc.getAddressParts(msg.address)
             value_list = msg.getValues()
@@ -182,7 +246,7 @@ class OscInterface(object):
 
         # Twisted OSC receiver
         self._osc_receiver = RosOscReceiver()
-        listener = async.DatagramServerProtocol(self._osc_receiver)
+        listener = TimestampedDatagramServerProtocol(self._osc_receiver)
         self._osc_receiver_port = reactor.listenUDP(self.osc_port,
                                                     listener)
 
@@ -200,6 +264,29 @@ class OscInterface(object):
         """
         return copy.copy(self._clients)
 
+    @property
+    def arrival_stamp(self):
+        """
+        Arrival time of the OSC datagram currently being dispatched, or of
+        the last one if called outside of an OSC callback.
+        @type: C{rospy.Time}
+        """
+        return self._osc_receiver.arrival_stamp
+
+    def send_binary(self, data, address):
+        """
+        Send an already encoded OSC element to a client.
+        
+        Encoding a bundle once with C{toBinary()} and sending the result to
+        several clients avoids re-encoding it for each destination.
+        
+        @type data: C{str}
+        @param data: Binary OSC message or bundle
+        @type address: C{tuple}
+        @param address: (address, port) of the client
+        """
+        self._osc_sender.transport.write(data, address)
+
     def bonjour_client_callback(self, client_list):
         """
         Callback when Bonjour client list is updated.
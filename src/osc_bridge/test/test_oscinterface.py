@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import roslib
+
+import unittest
+
+from txosc import osc
+
+from osc_bridge.oscinterface import RosOscReceiver
+
+
+class Test_RosOscReceiverSchema(unittest.TestCase):
+    def setUp(self):
+        self.receiver = RosOscReceiver()
+        self.received = []
+        self.fallback = []
+        self.receiver.addCallback("/1/fader1", self.callback)
+        self.receiver.addCallback("/accxyz", self.callback)
+        self.receiver.fallback = self.fallback_callback
+        self.receiver.addSchema({'/1/fader1': 'f', '/1/fader1/z': 'f'})
+        self.client = ("10.0.0.2", 9000)
+
+    def callback(self, address_list, value_list, send_address):
+        self.received.append((address_list, value_list))
+
+    def fallback_callback(self, address_list, value_list, send_address):
+        self.fallback.append((address_list, value_list))
+
+    def test_matching(self):
+        self.receiver.dispatch(osc.Message("/1/fader1", 0.5), self.client)
+        self.assertEqual(self.received, [(["1", "fader1"], [0.5])])
+        self.assertEqual(self.receiver.rejected, 0)
+
+    def test_wrongTypeTags(self):
+        self.receiver.dispatch(osc.Message("/1/fader1", 0.5, 0.5),
+                               self.client)
+        self.receiver.dispatch(osc.Message("/1/fader1", "text"), self.client)
+        self.receiver.dispatch(osc.Message("/1/fader1"), self.client)
+        self.assertEqual(self.received, [])
+        self.assertEqual(self.fallback, [])
+        self.assertEqual(self.receiver.rejected, 3)
+
+    def test_wrongTypeTagsInBundle(self):
+        bundle = osc.Bundle([osc.Message("/1/fader1", 1),
+                             osc.Message("/1/fader1", 0.25)])
+        self.receiver.dispatch(bundle, self.client)
+        self.assertEqual(self.received, [(["1", "fader1"], [0.25])])
+        self.assertEqual(self.receiver.rejected, 1)
+
+    def test_outsideSchema(self):
+        self.receiver.dispatch(osc.Message("/accxyz", 0.1, 0.2, 0.3),
+                               self.client)
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.receiver.rejected, 0)
+
+
+class Test_RosOscReceiverDirect(unittest.TestCase):
+    def setUp(self):
+        self.receiver = RosOscReceiver()
+        self.direct = []
+        self.pattern = []
+        self.fallback = []
+        self.receiver.addDirectCallback("/1/multi/2/3", self.direct_callback,
+                                        7)
+        self.receiver.addCallback("/1/multi/*/*", self.pattern_callback)
+        self.receiver.fallback = self.fallback_callback
+        self.client = ("10.0.0.2", 9000)
+
+    def direct_callback(self, index, value_list, send_address):
+        self.direct.append((index, value_list))
+
+    def pattern_callback(self, address_list, value_list, send_address):
+        self.pattern.append((address_list, value_list))
+
+    def fallback_callback(self, address_list, value_list, send_address):
+        self.fallback.append((address_list, value_list))
+
+    def test_directWins(self):
+        self.receiver.dispatch(osc.Message("/1/multi/2/3", 1.0), self.client)
+        self.assertEqual(self.direct, [(7, [1.0])])
+        self.assertEqual(self.pattern, [])
+
+    def test_patternFallsThrough(self):
+        self.receiver.dispatch(osc.Message("/1/multi/1/1", 1.0), self.client)
+        self.assertEqual(self.direct, [])
+        self.assertEqual(self.pattern, [(["1", "multi", "1", "1"], [1.0])])
+
+    def test_unmatched(self):
+        bundle = osc.Bundle([osc.Message("/1/multi/2/3", 0.0),
+                             osc.Message("/2/fader1", 0.5)])
+        self.receiver.dispatch(bundle, self.client)
+        self.assertEqual(self.direct, [(7, [0.0])])
+        self.assertEqual(self.fallback, [(["2", "fader1"], [0.5])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -127,6 +127,21 @@ class Control(etree.ElementBase):
 
     def getSendableMessages(self):
         return {self.name:{}}
+
+    def getSendableTypeTags(self):
+        """
+        Addresses TouchOSC sends for this control, relative to the tabpage,
+        with the OSC type tags of their arguments.
+
+        @rtype: dict
+        """
+        return {}
+
+    def set(self, key, value):
+        etree.ElementBase.set(self, key, value)
+        parent = self.getparent()
+        if parent is not None and hasattr(parent, 'invalidateIndex'):
+            parent.invalidateIndex()
     
     def getReceivableMessageTypes(self):
         position = dict()
@@ -250,6 +265,11 @@ class ScalableControl(Control):
         msg[self.name]['z'] = [bool]
         return msg
 
+    def getSendableTypeTags(self):
+        tags = super(ScalableControl, self).getSendableTypeTags()
+        tags[self.name + '/z'] = 'f'
+        return tags
+
 class Encoder(ScalableControl):
     def getSendableMessages(self):
         msg = super(Encoder, self).getSendableMessages()
@@ -261,6 +281,11 @@ class Encoder(ScalableControl):
         msg[self.name][None] = [bool]
         return msg
 
+    def getSendableTypeTags(self):
+        tags = super(Encoder, self).getSendableTypeTags()
+        tags[self.name] = 'f'
+        return tags
+
 class LED(ScalableControl):
     def getReceivableMessages(self):
         msg = super(LED, self).getReceivableMessages()
@@ -272,6 +297,9 @@ class LED(ScalableControl):
         msg[self.name][None] = [float, int] 
         return msg
 
+    def getSendableTypeTags(self):
+        return {}
+
 class Button(ScalableControl):
     @apply
     def local_off():
@@ -303,6 +331,11 @@ class Button(ScalableControl):
         msg[self.name][None] = [float, int]
         return msg
 
+    def getSendableTypeTags(self):
+        tags = super(Button, self).getSendableTypeTags()
+        tags[self.name] = 'f'
+        return tags
+
 class MultiButton(Button):
     @apply
     def number_x():
@@ -344,6 +377,14 @@ class MultiButton(Button):
         msg[self.name][None] = [0.0] * int(self.number_x) * int(self.number_y)
         return msg
 
+    def getSendableTypeTags(self):
+        tags = super(MultiButton, self).getSendableTypeTags()
+        del tags[self.name]
+        for x in range(1, int(self.number_x) + 1):
+            for y in range(1, int(self.number_y) + 1):
+                tags['%s/%d/%d' % (self.name, x, y)] = 'f'
+        return tags
+
 class XYPad(ScalableControl):
     @apply
     def invertx():
@@ -388,6 +429,11 @@ class XYPad(ScalableControl):
         msg[self.name][None] = [float, int]
         return msg
 
+    def getSendableTypeTags(self):
+        tags = super(XYPad, self).getSendableTypeTags()
+        tags[self.name] = 'ff'
+        return tags
+
 
 class Dial(ScalableControl):
     @apply
@@ -444,6 +490,11 @@ class Dial(ScalableControl):
         msg[self.name][None] = [float, int]
         return msg
 
+    def getSendableTypeTags(self):
+        tags = super(Dial, self).getSendableTypeTags()
+        tags[self.name] = 'f'
+        return tags
+
 
 class MultiDial(Dial):
     @apply
@@ -467,6 +518,13 @@ class MultiDial(Dial):
         msg[self.name][None] = [0.0] * int(self.number)
         msg[self.name]["number"] = int(self.number)
         return msg
+
+    def getSendableTypeTags(self):
+        tags = super(MultiDial, self).getSendableTypeTags()
+        del tags[self.name]
+        for i in range(1, int(self.number) + 1):
+            tags['%s/%d' % (self.name, i)] = 'f'
+        return tags
     
 class MultiXYPad(XYPad):
     def getReceivableMessages(self):
@@ -482,6 +540,13 @@ class MultiXYPad(XYPad):
         del msg[self.name][None]
         return msg
 
+    def getSendableTypeTags(self):
+        tags = dict()
+        for i in range(1, 6):
+            tags['%s/%d' % (self.name, i)] = 'ff'
+            tags['%s/%d/z' % (self.name, i)] = 'f'
+        return tags
+
 type_class_mapping = {
                 "led":          LED,
                 "labelv":       Label,
@@ -132,12 +132,13 @@ class Layout(object):
         return self._tabPages[tabpage].getReceiveDict()
         
     def getSendableMessages(self, tabpage):
-        sendDict = self.getNestedSendableMessages(tabpage)
-        return dict(self.walkDict(sendDict,'/' + str(tabpage)))
+        return dict(self._tabPages[tabpage].getSendIndex())
     
     def getReceivableMessages(self, tabpage):
-        receiveDict = self.getNestedReceivableMessages(tabpage)
-        return dict(self.walkDict(receiveDict,'/' + str(tabpage)))
+        return dict(self._tabPages[tabpage].getReceiveIndex())
+
+    def getSendTypeTags(self, tabpage):
+        return self._tabPages[tabpage].getSendTypeTags()
 
     def walkDict(self, aDict, path='', sep='/'):
         for k, v in aDict.iteritems():
@@ -30,13 +30,117 @@
 from lxml import etree
 import base64
 
+def flattenDict(aDict, path='', sep='/'):
+    """
+    Flatten a nested message dictionary into (address, value) pairs.  A key
+    of None holds the value of the address itself.
+
+    @type aDict: dict
+    @param aDict: Nested dictionary as returned by Tabpage.getSendDict
+    @type path: str
+    @param path: Address prefix
+    @rtype: list
+    """
+    items = []
+    stack = [(path, aDict)]
+    while stack:
+        (prefix, d) = stack.pop()
+        for k, v in d.iteritems():
+            new_path = prefix
+            if k:
+                new_path += sep + str(k)
+            if isinstance(v, dict):
+                stack.append((new_path, v))
+            else:
+                items.append((new_path, v))
+    return items
+
 class Tabpage(etree.ElementBase):
     """
     docstring
+
+    The flat address index returned by getSendIndex, getReceiveIndex and
+    getSendTypeTags is built on first use and cached on the element.  It is
+    invalidated when controls are added or removed through this class, when
+    a control's attributes are set, and whenever the number of controls
+    differs from when it was built.  lxml keeps the cache only as long as
+    this Python object is referenced, as a Layout does for its tabpages.
     """ 
     def _init(self):
         self.tag = "tabpage"
 
+    def set(self, key, value):
+        etree.ElementBase.set(self, key, value)
+        self.invalidateIndex()
+
+    def append(self, element):
+        etree.ElementBase.append(self, element)
+        self.invalidateIndex()
+
+    def extend(self, elements):
+        etree.ElementBase.extend(self, elements)
+        self.invalidateIndex()
+
+    def insert(self, index, element):
+        etree.ElementBase.insert(self, index, element)
+        self.invalidateIndex()
+
+    def remove(self, element):
+        etree.ElementBase.remove(self, element)
+        self.invalidateIndex()
+
+    def invalidateIndex(self):
+        """
+        Drop the cached address index, it is rebuilt on next use.
+        """
+        self.__dict__.pop('_index', None)
+
+    def _getIndex(self):
+        index = self.__dict__.get('_index')
+        if index is None or index[0] != len(self):
+            prefix = '/' + self.name
+            typeTags = dict()
+            for control in self.getchildren():
+                for (address, tags) in \
+                        control.getSendableTypeTags().iteritems():
+                    typeTags[prefix + '/' + address] = tags
+            index = (len(self),
+                     dict(flattenDict(self.getSendDict(), prefix)),
+                     dict(flattenDict(self.getReceiveDict(), prefix)),
+                     typeTags)
+            self.__dict__['_index'] = index
+        return index
+
+    def getSendIndex(self):
+        """
+        Flat dictionary of the addresses in getSendDict, including the
+        tabpage name, to their default values.  The dictionary is shared,
+        callers must not modify it.
+
+        @rtype: dict
+        """
+        return self._getIndex()[1]
+
+    def getReceiveIndex(self):
+        """
+        Flat dictionary of the addresses in getReceiveDict, including the
+        tabpage name, to their default values.  The dictionary is shared,
+        callers must not modify it.
+
+        @rtype: dict
+        """
+        return self._getIndex()[2]
+
+    def getSendTypeTags(self):
+        """
+        Dictionary of every address TouchOSC sends from this tabpage to the
+        OSC type tags of its arguments, e.g. {'/1/xy1': 'ff'}.  The
+        dictionary is shared, callers must not modify it.
+
+        @rtype: dict
+        """
+        return self._getIndex()[3]
+
     @apply
     def name():
         doc = """Tabpage Name"""
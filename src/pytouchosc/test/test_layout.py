@@ -61,6 +61,35 @@ class LayoutTest(unittest.TestCase):
         # Check for side effects
         self.assertEqual(path,'/1')
 
+    def test_sendIndex(self):
+        tp = Tabpage()
+        tp.name = "asdf"
+        tp.append(controls.control_factory("multifaderh", "mf1"))
+        self.layout.addTabpage(tp)
+        tags = self.layout.getSendTypeTags('asdf')
+        self.assertEqual(len(tags), 6)
+        self.assertEqual(tags['/asdf/mf1/5'], 'f')
+        self.assertEqual(self.layout.getSendableMessages('asdf'),
+                         {'/asdf/mf1': [0.0] * 5, '/asdf/mf1/z': False,
+                          '/asdf/mf1/number': 5,
+                          '/asdf/mf1/scalef': 0.0, '/asdf/mf1/scalet': 1.0})
+
+    def test_sendIndex_invalidated(self):
+        tp = Tabpage()
+        tp.name = "asdf"
+        # Elements built outside a parsed layout only keep their class while
+        # the Python object is alive
+        fader = controls.control_factory("faderh", "fader1")
+        led = controls.control_factory("led", "led1")
+        tp.append(fader)
+        self.assertEqual(tp.getSendTypeTags(),
+                         {'/asdf/fader1': 'f', '/asdf/fader1/z': 'f'})
+        tp.append(led)
+        self.assertIn('/asdf/led1', tp.getReceiveIndex())
+        fader.name = "fader2"
+        self.assertIn('/asdf/fader2', tp.getSendTypeTags())
+        self.assertNotIn('/asdf/fader1', tp.getSendTypeTags())
+
     def test_setOrientation(self):
         self.layout.orientation = 'vertical'
         self.assertEqual(self.layout.orientation, 'vertical')
@@ -218,6 +247,59 @@ class LayoutWriteTest(unittest.TestCase):
             self.layout.writeToFile(self.layoutPath)
         self.assertEqual(cm.exception.message, "Layout has no property: name, and filename parameter was not set")
 
+class TestSendTypeTags(unittest.TestCase):
+    def expected(self, name, control_type):
+        scalar = {name: 'f', name + '/z': 'f'}
+        if control_type in ["led", "labelv", "labelh", "batteryv",
+                            "batteryh", "timev", "timeh"]:
+            return {}
+        elif control_type in ["push", "toggle", "encoder", "faderv",
+                              "faderh", "rotaryv", "rotaryh"]:
+            return scalar
+        elif control_type == "xy":
+            return {name: 'ff', name + '/z': 'f'}
+        elif control_type in ["multipush", "multitoggle"]:
+            tags = {name + '/z': 'f'}
+            for x in range(1, 6):
+                for y in range(1, 7):
+                    tags['%s/%d/%d' % (name, x, y)] = 'f'
+            return tags
+        elif control_type in ["multifaderv", "multifaderh"]:
+            tags = {name + '/z': 'f'}
+            for i in range(1, 6):
+                tags['%s/%d' % (name, i)] = 'f'
+            return tags
+        elif control_type == "multixy":
+            tags = {}
+            for i in range(1, 6):
+                tags['%s/%d' % (name, i)] = 'ff'
+                tags['%s/%d/z' % (name, i)] = 'f'
+            return tags
+        self.fail("No expectation for %s" % control_type)
+
+    def test_allTypes(self):
+        for control_type in controls.type_class_mapping:
+            control = controls.control_factory(control_type, "c")
+            self.assertEqual(control.getSendableTypeTags(),
+                             self.expected("c", control_type),
+                             control_type)
+
+    def test_tabpage(self):
+        tp = Tabpage()
+        tp.name = "tp"
+        expected = {}
+        kept = []
+        for control_type in controls.type_class_mapping:
+            control = controls.control_factory(control_type, control_type)
+            control.scalef = 0.0
+            control.scalet = 1.0
+            kept.append(control)
+            tp.append(control)
+            for (address, tags) in \
+                    self.expected(control_type, control_type).iteritems():
+                expected['/tp/' + address] = tags
+        self.assertEqual(tp.getSendTypeTags(), expected)
+
 class TestAllControls(unittest.TestCase):
     def randColor(self):
         colors = controls.Control.colors
@@ -267,6 +349,7 @@ def suite():
     suite.addTests(load.loadTestsFromTestCase(LayoutTest_CreateFromExistingZip))
     suite.addTests(load.loadTestsFromTestCase(LayoutTest_CreateFromExistingFile))
     suite.addTests(load.loadTestsFromTestCase(LayoutWriteTest))
+    suite.addTests(load.loadTestsFromTestCase(TestSendTypeTags))
     return suite
 
 def rostest():
@@ -275,6 +358,7 @@ def rostest():
     suite.append(['CreateFromExistingFile', LayoutTest_CreateFromExistingFile])
     suite.append(['CreateFromExistingZip', LayoutTest_CreateFromExistingZip])
     suite.append(['WriteLayout', LayoutWriteTest])
+    suite.append(['SendTypeTags', TestSendTypeTags])
     return suite
 
 if __name__ == "__main__":
@@ -9,11 +9,83 @@ from twisted.internet import reactor
 
 import socket
 
+#: Distance (m/s, rad/s) at which the filtered velocity settles on its target
+SETTLE = 1e-3
+
+def step_velocity(target, filtered, cmd, limits, alpha):
+    """
+    Move a velocity one output step towards its target.  C{filtered}
+    follows C{target} through a first order low-pass filter with gain
+    C{alpha}, and each component of C{cmd} follows C{filtered} changing by at
+    most the matching entry of C{limits}.  Once the filter is within
+    C{SETTLE} of the target it is snapped onto it, so a robot comes to an
+    exact stop.  C{filtered} and C{cmd} are updated in place.
+    
+    @return: True if the resulting C{cmd} is not zero
+    @rtype: C{bool}
+    """
+    for i in range(len(cmd)):
+        filtered[i] += alpha * (target[i] - filtered[i])
+        if abs(target[i] - filtered[i]) < SETTLE:
+            filtered[i] = target[i]
+        cmd[i] += max(min(filtered[i] - cmd[i], limits[i]), -limits[i])
+    return any(cmd)
+
+
+class RobotState(object):
+    """
+    Teleoperation state of one robot.  Velocities are kept as [x, y, w]
+    lists.
+    """
+    __slots__ = ('namespace', 'tabpages', 'pub', 'target', 'filtered', 'cmd',
+                 'master_osc', 'active_clients', 'holonomic', 'running',
+                 'last_master_packet', 'input_stamp')
+
+    def __init__(self, namespace, holonomic, running):
+        self.namespace = namespace
+        self.tabpages = []
+        self.pub = None
+        # Velocity requested by the master client
+        self.target = [0.0, 0.0, 0.0]
+        # Low-pass filtered target
+        self.filtered = [0.0, 0.0, 0.0]
+        # Published velocity
+        self.cmd = [0.0, 0.0, 0.0]
+        self.master_osc = None
+        self.active_clients = set()
+        self.holonomic = holonomic
+        self.running = running
+        self.last_master_packet = 0.0
+        # Arrival time of the first input not yet published
+        self.input_stamp = None
+
+    def zero_target(self):
+        self.target[0] = 0.0
+        self.target[1] = 0.0
+        self.target[2] = 0.0
+
+
 class TeleopTabpageHandler(AbstractTabpageHandler):
+    """
+    Tabpage handler that drives robot bases from an XY pad and a W fader.
+    
+    Each tabpage alias drives the robot in the namespace given for it in the
+    C{robots} parameter (a dict of alias to namespace), and aliases without
+    an entry drive C{cmd_vel} in the node's namespace.  Aliases mapped to the
+    same namespace share one robot.
+    
+    OSC input from a robot's master client only sets its target velocity.
+    The C{cmd_vel} outputs of all robots being driven are published by one
+    tick at a fixed C{rate}, following the target through a first order
+    low-pass filter with time constant C{filter_tau} and acceleration limits
+    C{max_ax}, C{max_ay} and C{max_aw}.  If the master has sent nothing for
+    C{deadman_timeout} seconds the target is set to zero.
+    """
     def __init__(self, touchosc_interface, handler_name, tabpage_names,
                  max_vx=0.6, max_vy=0.6, max_vw=0.8,
                  max_run_vx=1.0, max_run_vy=1.0, max_run_vw=1.0,
-                 run=False):
+                 run=False, rate=20.0, max_ax=1.0, max_ay=1.0, max_aw=2.0,
+                 filter_tau=0.1, deadman_timeout=0.0):
         super(TeleopTabpageHandler, self).__init__(touchosc_interface,
                                                    handler_name,
                                                    tabpage_names)
@@ -25,11 +97,49 @@ class TeleopTabpageHandler(AbstractTabpageHandler):
         self.max_run_vx = rospy.get_param(pref + "max_run_vx", max_run_vx)
         self.max_run_vy = rospy.get_param(pref + "max_run_vy", max_run_vy)
         self.max_run_vw = rospy.get_param(pref + "max_run_vw", max_run_vw)
-        self.running = rospy.get_param(pref + "run", run)
-        self.minPublishFreq = rospy.get_param(pref + "min_freq", 10)
+        self.default_running = rospy.get_param(pref + "run", run)
+        self.rate = rospy.get_param(pref + "rate", rate)
+        if self.rate <= 0:
+            rospy.logwarn("%srate must be positive, got %s, using %s" %
+                          (pref, self.rate, rate))
+            self.rate = rate
+        self.max_ax = rospy.get_param(pref + "max_ax", max_ax)
+        self.max_ay = rospy.get_param(pref + "max_ay", max_ay)
+        self.max_aw = rospy.get_param(pref + "max_aw", max_aw)
+        self.filter_tau = rospy.get_param(pref + "filter_tau", filter_tau)
+        if self.filter_tau < 0:
+            rospy.logwarn("%sfilter_tau must not be negative, got %s, "
+                          "using %s" % (pref, self.filter_tau, filter_tau))
+            self.filter_tau = filter_tau
+        self.deadman_timeout = rospy.get_param(pref + "deadman_timeout",
+                                               deadman_timeout)
         self.default_mode = rospy.get_param(pref + "default_mode", True)
+        self.mirror_rate = rospy.get_param(pref + "mirror_rate", 10.0)
+        if self.mirror_rate <= 0:
+            rospy.logwarn("%smirror_rate must be positive, got %s, using 10.0"
+                          % (pref, self.mirror_rate))
+            self.mirror_rate = 10.0
+        namespaces = rospy.get_param(pref + "robots", {})
+
+        # tabpage alias -> RobotState
+        self.robots = {}
+        by_namespace = {}
+        for tabpage in self.tabpage_names:
+            namespace = namespaces.get(tabpage, '')
+            if not by_namespace.has_key(namespace):
+                by_namespace[namespace] = RobotState(namespace,
+                                                     self.default_mode,
+                                                     self.default_running)
+                # Registered up front so the first commands are not lost
+                # while subscribers connect
+                by_namespace[namespace].pub = rospy.Publisher(
+                    rospy.names.ns_join(namespace, "cmd_vel"), Twist)
+            robot = by_namespace[namespace]
+            robot.tabpages.append(tabpage)
+            self.robots[tabpage] = robot
+        # Robots that have a master or are still moving
+        self.active_robots = set()
 
-        self.pub = rospy.Publisher("cmd_vel", Twist)
         self.add_osc_callback('xy', self.xypad_callback)
         self.add_osc_callback('w', self.w_callback)
         self.add_osc_callback('control', self.control_callback)
@@ -37,174 +147,261 @@ class TeleopTabpageHandler(AbstractTabpageHandler):
         self.add_osc_callback('turbo', self.turbo_callback)
 
         self.cmd = Twist()
-        self.cmd.linear.x = 0.0
-        self.cmd.linear.y = 0.0
-        self.cmd.angular.z = 0.0
-
-        self.holonomic = self.default_mode
-        self.master_osc = None
-        reactor.callLater(1.0 / self.minPublishFreq, self.publish_cmd)
-        self.active_clients = set()
+        reactor.callLater(1.0 / self.rate, self.publish_cmd)
 
     def initializeTabpage(self):
-        self.zero_command()
+        for robot in set(self.robots.itervalues()):
+            self.zero_command(robot)
 
-    def zero_command(self):
+    def zero_command(self, robot):
         self.send(osc.Bundle([osc.Message('xy', 0.0, 0.0),
                               osc.Message('w', 0.0),
                               osc.Message('control', 0.0),
                               osc.Message('mapping', 0.0),
                               osc.Message('turbo', 0.0),
                               osc.Message('mapping_label', "holonomic"),
-                              osc.Message('master', "")]))
-        self.cmd.linear.x = 0.0
-        self.cmd.linear.y = 0.0
-        self.cmd.angular.z = 0.0
-        self.holonomic = True
-        self.running = False
-
-    def reset_tabpage(self, client):
+                              osc.Message('master', "")]),
+                  tabpages=robot.tabpages)
+        robot.zero_target()
+        robot.holonomic = True
+        robot.running = False
+
+    def reset_tabpage(self, client, robot):
         bundle = osc.Bundle()
         bundle.add(osc.Message('xy', 0.0, 0.0))
         bundle.add(osc.Message('w', 0.0))
-        if self.master_osc:
+        if robot.master_osc:
             bundle.add(osc.Message('control', 1.0))
-            bundle.add(osc.Message('master', self.master_osc))
+            bundle.add(osc.Message('master', robot.master_osc))
         else:
             bundle.add(osc.Message('control', 0.0))
             bundle.add(osc.Message('master', ''))
-        if self.holonomic:
+        if robot.holonomic:
             bundle.add(osc.Message('mapping_label', 'Holonomic'))
             bundle.add(osc.Message('w/visible', 1.0))
         else:
             bundle.add(osc.Message('mapping_label', 'Differential'))
             bundle.add(osc.Message('w/visible', 0.0))
         bundle.add(osc.Message('mapping', 0.0))
-        if self.running:
+        if robot.running:
             bundle.add(osc.Message('turbo', 1.0))
         else:
             bundle.add(osc.Message('turbo', 0.0))
-        self.send(bundle, clients=[client])
+        self.send(bundle, clients=[client], tabpages=robot.tabpages)
+
+    def zero_xy_command(self, robot):
+        self.send(osc.Message('xy', 0.0, 0.0), tabpages=robot.tabpages)
+        robot.target[0] = 0.0
+        robot.target[1] = 0.0
+
+    def zero_w_command(self, robot):
+        self.send(osc.Message('w', 0.0), tabpages=robot.tabpages)
+        robot.target[2] = 0.0
 
-    def zero_xy_command(self):
-        self.send(osc.Message('xy', 0.0, 0.0))
-        self.cmd.linear.x = 0.0
-        self.cmd.linear.y = 0.0
+    def set_master(self, robot, client):
+        """
+        Give control of a robot to a client, or release it if C{client} is
+        None.
+        """
+        robot.master_osc = client
+        if client:
+            robot.last_master_packet = rospy.get_time()
+            self.active_robots.add(robot)
+
+    def mirror_clients(self, tabpages=None):
+        """
+        Pad positions of a robot's master are mirrored to the other clients
+        that have one of the robot's tabpages open.  Without C{tabpages},
+        the observers of every robot are returned.
+        """
+        if tabpages:
+            robots = [self.robots[tabpages[0]]]
+        else:
+            robots = set(self.robots.itervalues())
+        clients = []
+        for (address, client) in self.parent.clients.iteritems():
+            active_tabpage = client.active_tabpage
+            for robot in robots:
+                if (address != robot.master_osc and
+                    active_tabpage in robot.tabpages):
+                    clients.append(address)
+                    break
+        return clients
 
-    def zero_w_command(self):
-        self.send(osc.Message('w', 0.0))
-        self.cmd.angular.z = 0.0
+    def update_cmd(self, robot, dt):
+        """
+        Move the published velocity of a robot one step of C{dt} seconds
+        towards its target, through the low-pass filter and the acceleration
+        limits.
+        
+        @return: True if the published velocity is not zero
+        @rtype: C{bool}
+        """
+        return step_velocity(robot.target, robot.filtered, robot.cmd,
+                             [self.max_ax * dt, self.max_ay * dt,
+                              self.max_aw * dt],
+                             dt / (self.filter_tau + dt))
 
     def publish_cmd(self):
         """
-        Callback for a periodic publish update.  Do not publish if there are no active clients.
+        Callback for the fixed rate output stage, shared by all robots.
+        Publishes for every robot that has a master client, and afterwards
+        until that robot has been brought to a stop.
         """
-        if self.master_osc and len(self.active_clients) != 0:
-            if self.master_osc and self.master_osc not in self.active_clients:
-                self.send(osc.Bundle([osc.Message('control', 0.0),
-                                      osc.Message('master', '')]))
-                self.master_osc = None
-            elif self.master_osc:
-                self.send(osc.Message('control', 1.0), clients=[self.master_osc])
-            self.pub.publish(self.cmd)
-        reactor.callLater(1.0 / self.minPublishFreq, self.publish_cmd)
+        now = rospy.get_time()
+        for robot in list(self.active_robots):
+            if robot.master_osc and len(robot.active_clients) != 0:
+                if robot.master_osc not in robot.active_clients:
+                    self.send(osc.Bundle([osc.Message('control', 0.0),
+                                          osc.Message('master', '')]),
+                              tabpages=robot.tabpages)
+                    self.set_master(robot, None)
+                else:
+                    self.send(osc.Message('control', 1.0),
+                              clients=[robot.master_osc],
+                              tabpages=robot.tabpages)
+            if not robot.master_osc or (self.deadman_timeout > 0.0 and
+                                        now - robot.last_master_packet >
+                                        self.deadman_timeout):
+                robot.zero_target()
+            moving = any(robot.cmd)
+            if self.update_cmd(robot, 1.0 / self.rate) or moving or \
+                    robot.master_osc:
+                (self.cmd.linear.x, self.cmd.linear.y,
+                 self.cmd.angular.z) = robot.cmd
+                robot.pub.publish(self.cmd)
+                if robot.input_stamp is not None:
+                    self.record_latency(robot.input_stamp)
+                    robot.input_stamp = None
+            else:
+                self.active_robots.discard(robot)
+        reactor.callLater(1.0 / self.rate, self.publish_cmd)
 
     def xypad_callback(self, address_list, value_list, send_address):
-        if send_address[0] not in self.active_clients:
-            self.active_clients.add(send_address[0])
-        if send_address[0] == self.master_osc and len(address_list) == 2:
-            self.send(osc.Message('xy', *value_list))
-            vx = self.max_run_vx if self.running else self.max_vx
-            vy = self.max_run_vy if self.running else self.max_vy
-            self.cmd.linear.x = max(min(value_list[0] * vx, vx), -vx)
-            if self.holonomic:
-                self.cmd.linear.y = max(min(value_list[1] * -vy, vy), -vy)
+        robot = self.robots[address_list[0]]
+        if send_address[0] not in robot.active_clients:
+            robot.active_clients.add(send_address[0])
+        if send_address[0] == robot.master_osc:
+            robot.last_master_packet = rospy.get_time()
+        if send_address[0] == robot.master_osc and len(address_list) == 2:
+            self.mirror(osc.Message('xy', *value_list), send_address[0],
+                        tabpages=robot.tabpages)
+            if robot.input_stamp is None:
+                robot.input_stamp = self.parent.arrival_stamp
+            vx = self.max_run_vx if robot.running else self.max_vx
+            vy = self.max_run_vy if robot.running else self.max_vy
+            robot.target[0] = max(min(value_list[0] * vx, vx), -vx)
+            if robot.holonomic:
+                robot.target[1] = max(min(value_list[1] * -vy, vy), -vy)
             else:
-                self.cmd.angular.z = max(min(value_list[1] * -vy, vy), -vy)
-        elif send_address[0] == self.master_osc and value_list[0] == 0.0:
-            self.cmd.linear.x = 0.0
-            self.cmd.linear.y = 0.0
-            if not self.holonomic:
-                self.cmd.angular.z = 0.0
-            self.zero_xy_command()
-        self.pub.publish(self.cmd)
+                robot.target[2] = max(min(value_list[1] * -vy, vy), -vy)
+        elif send_address[0] == robot.master_osc and value_list[0] == 0.0:
+            robot.target[0] = 0.0
+            robot.target[1] = 0.0
+            if not robot.holonomic:
+                robot.target[2] = 0.0
+            self.zero_xy_command(robot)
 
     def w_callback(self, address_list, value_list, send_address):
-        if not self.holonomic:
+        robot = self.robots[address_list[0]]
+        if not robot.holonomic:
             return
-        if send_address[0] not in self.active_clients:
-            self.active_clients.add(send_address[0])
-        if send_address[0] == self.master_osc and len(address_list) == 2:
-            self.send(osc.Message('w', *value_list))
-            vw = self.max_run_vw if self.running else self.max_vw
-            self.cmd.angular.z = max(min(value_list[0] * -vw, vw), -vw)
-        elif send_address[0] == self.master_osc and value_list[0] == 0.0:
-            self.cmd.angular.z = 0.0
-            self.zero_w_command()
-        self.pub.publish(self.cmd)
+        if send_address[0] not in robot.active_clients:
+            robot.active_clients.add(send_address[0])
+        if send_address[0] == robot.master_osc:
+            robot.last_master_packet = rospy.get_time()
+        if send_address[0] == robot.master_osc and len(address_list) == 2:
+            self.mirror(osc.Message('w', *value_list), send_address[0],
+                        tabpages=robot.tabpages)
+            if robot.input_stamp is None:
+                robot.input_stamp = self.parent.arrival_stamp
+            vw = self.max_run_vw if robot.running else self.max_vw
+            robot.target[2] = max(min(value_list[0] * -vw, vw), -vw)
+        elif send_address[0] == robot.master_osc and value_list[0] == 0.0:
+            robot.target[2] = 0.0
+            self.zero_w_command(robot)
 
     def mapping_callback(self, address_list, value_list, send_address):
+        robot = self.robots[address_list[0]]
         if len(address_list) == 2:
-            self.holonomic = not self.holonomic
-            self.send(osc.Message('w/visible', int(self.holonomic)))
-            if self.holonomic:
-                self.send(osc.Message('mapping_label', "Holonomic"))
+            robot.holonomic = not robot.holonomic
+            self.send(osc.Message('w/visible', int(robot.holonomic)),
+                      tabpages=robot.tabpages)
+            if robot.holonomic:
+                self.send(osc.Message('mapping_label', "Holonomic"),
+                          tabpages=robot.tabpages)
             else:
-                self.send(osc.Message('mapping_label', "Differential"))
+                self.send(osc.Message('mapping_label', "Differential"),
+                          tabpages=robot.tabpages)
 
     def control_callback(self, address_list, value_list, send_address):
+        robot = self.robots[address_list[0]]
         if len(address_list) == 2:
-            if send_address[0] not in self.active_clients:
-                self.active_clients.add(send_address[0])
-                if not self.master_osc:
-                    name = self.master_osc
+            if send_address[0] not in robot.active_clients:
+                robot.active_clients.add(send_address[0])
+                if not robot.master_osc:
+                    name = robot.master_osc
                     self.send(osc.Message('control', 1.0),
-                              clients=[self.master_osc])
-                    self.send(osc.Message('master', name))
-            elif not self.master_osc and value_list[0] == 1.0:
-                self.master_osc = send_address[0]
-                name = self.master_osc
-                self.send(osc.Message('control', 1.0), clients=[self.master_osc])
-                self.send(osc.Message('master', name))
+                              clients=[robot.master_osc],
+                              tabpages=robot.tabpages)
+                    self.send(osc.Message('master', name),
+                              tabpages=robot.tabpages)
+            elif not robot.master_osc and value_list[0] == 1.0:
+                self.set_master(robot, send_address[0])
+                name = robot.master_osc
+                self.send(osc.Message('control', 1.0),
+                          clients=[robot.master_osc], tabpages=robot.tabpages)
+                self.send(osc.Message('master', name), tabpages=robot.tabpages)
             elif value_list[0] == 0.0:
-                self.send(osc.Message('control', 0.0))
-                self.send(osc.Message('master', ''))
-                self.master_osc = None
+                self.send(osc.Message('control', 0.0), tabpages=robot.tabpages)
+                self.send(osc.Message('master', ''), tabpages=robot.tabpages)
+                self.set_master(robot, None)
 
     def turbo_callback(self, address_list, value_list, send_address):
-        if send_address[0] not in self.active_clients:
-                self.active_clients.add(send_address[0])
-        if send_address[0] == self.master_osc and len(address_list) == 2:
+        robot = self.robots[address_list[0]]
+        if send_address[0] not in robot.active_clients:
+                robot.active_clients.add(send_address[0])
+        if send_address[0] == robot.master_osc:
+            robot.last_master_packet = rospy.get_time()
+        if send_address[0] == robot.master_osc and len(address_list) == 2:
             if value_list[0] == 1.0:
                 message = osc.Message("turbo", value_list[0])
-                self.send(message)
-                self.running = True
+                self.send(message, tabpages=robot.tabpages)
+                robot.running = True
             elif value_list[0] == 0.0:
                 message = osc.Message("turbo", value_list[0])
-                self.send(message)
-                self.running = False
+                self.send(message, tabpages=robot.tabpages)
+                robot.running = False
+
+    def release_robot(self, client, robot):
+        """
+        Release a robot if C{client} is its master and forget the client.
+        """
+        if client == robot.master_osc:
+            robot.holonomic = self.default_mode
+            robot.running = False
+            self.send(osc.Bundle([osc.Message('control', 0.0),
+                                  osc.Message('master', '')]),
+                      tabpages=robot.tabpages)
+            self.set_master(robot, None)
+            return True
+        robot.active_clients.discard(client)
+        return False
 
-    def cb_tagpage_opened(self, client, tabpage):
-        self.reset_tabpage(client)
+    def cb_tabpage_active(self, client, tabpage):
+        self.reset_tabpage(client, self.robots[tabpage])
 
     def cb_client_connected(self, client):
-        self.reset_tabpage(client)
+        for robot in set(self.robots.itervalues()):
+            self.reset_tabpage(client, robot)
 
     def cb_tabpage_closed(self, client, tabpage):
-        if client == self.master_osc:
-            self.holonomic = self.default_mode
-            self.running = False
-            self.send(osc.Bundle([osc.Message('control', 0.0),
-                                  osc.Message('master', '')]))
-            self.master_osc = None
-            self.reset_tabpage(client)
-        self.active_clients.discard(client)
+        robot = self.robots[tabpage]
+        if self.release_robot(client, robot):
+            self.reset_tabpage(client, robot)
+        robot.active_clients.discard(client)
 
     def cb_client_disconnected(self, client):
-        if client == self.master_osc:
-            self.holonomic = self.default_mode
-            self.running = False
-            self.send(osc.Bundle([osc.Message('control', 0.0),
-                                  osc.Message('master', '')]))
-            self.master_osc = None
-        self.active_clients.discard(client)
+        for robot in set(self.robots.itervalues()):
+            self.release_robot(client, robot)
+            robot.active_clients.discard(client)
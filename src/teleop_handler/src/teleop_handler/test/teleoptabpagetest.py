@@ -0,0 +1,108 @@
+import unittest
+
+import roslib
+import rospy
+
+from teleop_handler.teleoptabpage import step_velocity, TeleopTabpageHandler
+
+
+class FakeClient(object):
+    def __init__(self, active_tabpage):
+        self.active_tabpage = active_tabpage
+
+
+class FakeInterface(object):
+    """
+    The parts of TouchOscInterface that the teleop handler uses.
+    """
+    def __init__(self):
+        self.clients = {}
+
+
+class Test_StepVelocity(unittest.TestCase):
+    def setUp(self):
+        self.filtered = [0.0, 0.0, 0.0]
+        self.cmd = [0.0, 0.0, 0.0]
+        # 20 Hz output, 1 m/s^2, 1 m/s^2, 2 rad/s^2, tau 0.1 s
+        self.limits = [0.05, 0.05, 0.1]
+        self.alpha = 0.05 / (0.1 + 0.05)
+
+    def step(self, target, steps=1):
+        for i in range(steps):
+            moving = step_velocity(target, self.filtered, self.cmd,
+                                   self.limits, self.alpha)
+        return moving
+
+    def test_acceleration_limit(self):
+        self.assertTrue(self.step([1.0, -1.0, 1.0]))
+        self.assertAlmostEqual(self.cmd[0], 0.05)
+        self.assertAlmostEqual(self.cmd[1], -0.05)
+        self.assertAlmostEqual(self.cmd[2], 0.1)
+        previous = list(self.cmd)
+        for i in range(20):
+            self.step([1.0, -1.0, 1.0])
+            for j in range(3):
+                self.assertLessEqual(abs(self.cmd[j] - previous[j]),
+                                     self.limits[j] + 1e-9)
+            previous = list(self.cmd)
+
+    def test_filter_below_limit(self):
+        self.step([0.01, 0.0, 0.0])
+        self.assertAlmostEqual(self.filtered[0], 0.01 * self.alpha)
+        self.assertAlmostEqual(self.cmd[0], 0.01 * self.alpha)
+
+    def test_convergence(self):
+        self.step([0.6, 0.3, -0.8], steps=100)
+        for (value, target) in zip(self.cmd, [0.6, 0.3, -0.8]):
+            self.assertAlmostEqual(value, target, places=6)
+
+    def test_stop(self):
+        self.step([0.6, 0.0, 0.0], steps=100)
+        self.assertFalse(self.step([0.0, 0.0, 0.0], steps=200))
+        self.assertEqual(self.cmd, [0.0, 0.0, 0.0])
+
+
+class Test_TeleopTabpageHandler(unittest.TestCase):
+    def setUp(self):
+        self.params = {"~teleop/robots": {"robot2": "/robot2"}}
+        self.saved = (rospy.get_param, rospy.Publisher)
+        rospy.get_param = self.params.get
+        rospy.Publisher = lambda name, data_class: name
+        self.parent = FakeInterface()
+
+    def tearDown(self):
+        (rospy.get_param, rospy.Publisher) = self.saved
+
+    def make_handler(self):
+        return TeleopTabpageHandler(self.parent, "teleop",
+                                    ["teleop", "teleop2", "robot2"])
+
+    def test_mirror_clients(self):
+        handler = self.make_handler()
+        self.parent.clients = {"master": FakeClient("teleop"),
+                               "observer": FakeClient("teleop2"),
+                               "other": FakeClient("robot2"),
+                               "away": FakeClient("settings")}
+        handler.set_master(handler.robots["teleop"], "master")
+        # Observers have only opened the tabpage and sent nothing
+        self.assertEqual(handler.mirror_clients(("teleop",)), ["observer"])
+        self.assertEqual(handler.mirror_clients(("robot2",)), ["other"])
+        self.assertEqual(sorted(handler.mirror_clients()),
+                         ["observer", "other"])
+
+    def test_publishers_at_startup(self):
+        handler = self.make_handler()
+        self.assertEqual(handler.robots["teleop"].pub, "cmd_vel")
+        self.assertTrue(handler.robots["teleop2"] is handler.robots["teleop"])
+        self.assertEqual(handler.robots["robot2"].pub, "/robot2/cmd_vel")
+
+    def test_invalid_params(self):
+        self.params["~teleop/filter_tau"] = -0.5
+        self.params["~teleop/mirror_rate"] = 0
+        handler = self.make_handler()
+        self.assertEqual(handler.filter_tau, 0.1)
+        self.assertEqual(handler.mirror_rate, 10.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,7 @@ from txosc import dispatch
 from txosc import async
 
 from diagnostic_msgs.msg import DiagnosticStatus, KeyValue
+from twisted.internet import reactor
 import copy
 
 class AbstractTabpageHandler(object):
@@ -40,10 +41,24 @@ class AbstractTabpageHandler(object):
         for name in self.tabpage_names:
             self.osc_node[name] = {}
             self.osc_node[name][None] = dispatch.AddressNode(name)
+        # Full OSC address -> (callback, index), see add_osc_direct_callback
+        self.osc_direct = {}
+        # Full OSC address -> expected type tags of incoming messages
+        self.osc_schema = {}
 
         self.ros_publishers = {}
         self.ros_subscribers = {}
 
+        # Rate (Hz) at which mirrored state is sent to observers
+        self.mirror_rate = 10.0
+        # address -> (message, source client) waiting to be mirrored
+        self._mirror_pending = {}
+        self._mirror_call = None
+
+        # Number, total and maximum of the arrival to publish latencies
+        # since the last diagnostics update
+        self._latency = [0, 0.0, 0.0]
+
     @property
     def osc_nodes(self):
         """
@@ -167,24 +182,113 @@ class AbstractTabpageHandler(object):
         else:
             iter_tabpages = self.tabpage_names
 
+        # The bundle is the same for every destination, so it is built and
+        # encoded once and the resulting datagram is written to each client.
+        clientBundle = osc.Bundle()
+        for tab in iter_tabpages:
+            elem = copy.copy(element)
+            basename = '/' + tab
+            if type(elem) is osc.Bundle:
+                for msg in elem.getMessages():
+                    clientBundle.add(osc.Message('/'.join([basename,
+                                                           msg.address]),
+                                                 *msg.getValues()))
+            elif type(elem) is osc.Message:
+                elem.address = '/'.join([basename, elem.address])
+                clientBundle.add(elem)
+        data = clientBundle.toBinary()
+
         for destination in iter_clients:
-            clientBundle = osc.Bundle()
-            for tab in iter_tabpages:
-                elem = copy.copy(element)
-                basename = '/' + tab
-                if type(elem) is osc.Bundle:
-                    for msg in elem.getMessages():
-                        clientBundle.add(osc.Message('/'.join([basename,
-                                                               msg.address]),
-                                                     *msg.getValues()))
-                elif type(elem) is osc.Message:
-                    elem.address = '/'.join([basename, elem.address])
-                    clientBundle.add(elem)
             try:
                 dest_address = reg_clients[destination].send_tuple
-                self.parent._osc_sender.send(clientBundle, dest_address)
             except KeyError:
                 continue
+            self.parent.send_binary(data, dest_address)
+
+    def mirror(self, message, source, tabpages=None):
+        """
+        Mirror a control state received from one client to the observers
+        returned by L{mirror_clients}, never echoing it to the source.
+        
+        Only the latest message for each address is kept, and pending
+        messages are sent as one bundle per source at most C{mirror_rate}
+        times per second, so fast input from one client does not flood the
+        others.
+        
+        @param message: OSC message with the state to mirror
+        @type message: C{osc.Message}
+        @param source: IP address of the client the state came from
+        @type source: C{str}
+        @param tabpages: Tabpages to mirror to, defaults to all tabpages of
+        this handler
+        @type tabpages: C{list}
+        """
+        if tabpages is not None:
+            tabpages = tuple(tabpages)
+        self._mirror_pending[(message.address, tabpages)] = (message, source)
+        if self._mirror_call is None:
+            self._mirror_call = reactor.callLater(1.0 / self.mirror_rate,
+                                                  self._flush_mirror)
+
+    def mirror_clients(self, tabpages=None):
+        """
+        Clients that receive state mirrored to C{tabpages}.  Defaults to all
+        clients; handlers may override this to select their observers.
+        
+        @param tabpages: Tabpages the state is mirrored to, or None for all
+        @type tabpages: C{tuple}
+        @rtype: C{list}
+        """
+        return self.parent.clients.keys()
+
+    def _flush_mirror(self):
+        """
+        Send the pending mirrored messages.
+        """
+        self._mirror_call = None
+        groups = {}
+        for ((_, tabpages), (message, source)) in \
+                self._mirror_pending.iteritems():
+            groups.setdefault((source, tabpages), []).append(message)
+        self._mirror_pending = {}
+        for ((source, tabpages), messages) in groups.iteritems():
+            clients = [client for client in self.mirror_clients(tabpages)
+                       if client != source]
+            if clients:
+                self.send(osc.Bundle(messages), clients=clients,
+                          tabpages=list(tabpages) if tabpages else None)
+
+    def record_latency(self, arrival_stamp):
+        """
+        Record the time from the arrival of an OSC packet to the publication
+        of the ROS message it caused.  Call just after publishing.
+        
+        @param arrival_stamp: Arrival time of the packet, as given by
+        C{self.parent.arrival_stamp} in the OSC callback
+        @type arrival_stamp: C{rospy.Time}
+        """
+        latency = (rospy.Time.now() - arrival_stamp).to_sec()
+        stats = self._latency
+        stats[0] += 1
+        stats[1] += latency
+        if latency > stats[2]:
+            stats[2] = latency
+
+    def latency_values(self):
+        """
+        Diagnostics values for the latencies recorded since the last call.
+        
+        @rtype: C{list} of C{diagnostic_msgs/KeyValue}
+        """
+        (count, total, maximum) = self._latency
+        self._latency = [0, 0.0, 0.0]
+        if not count:
+            return []
+        return [KeyValue(key="Input Latency Mean (ms)",
+                         value="%.2f" % (1000.0 * total / count)),
+                KeyValue(key="Input Latency Max (ms)",
+                         value="%.2f" % (1000.0 * maximum)),
+                KeyValue(key="Input Messages", value=str(count))]
 
     def cb_diagnostics_update(self):
         """
@@ -200,7 +304,7 @@ class AbstractTabpageHandler(object):
                                         "Handler"])
         tabpage_status.hardware_id = self.parent.ros_name
         tabpage_status.message = "OK"
-        tabpage_status.values = []
+        tabpage_status.values = self.latency_values()
         return tabpage_status
 
     def initialize_tabpage(self):
@@ -297,7 +401,7 @@ class AbstractTabpageHandler(object):
             if tabpage not in self.tabpage_names:
                 rospy.logwarn("Tried to add control %s to tabpage %s" %
                                (name, tabpage))
-                rospy.logwarn("Cannot add callbacks to an unaliased tabage")
+                rospy.logwarn("Cannot add callbacks to an unaliased tabpage")
                 continue
             node = self.osc_node[tabpage]
             node[name] = dispatch.AddressNode(name)
@@ -319,3 +423,40 @@ class AbstractTabpageHandler(object):
                 # Match /tabpage/control/2/2 value
                 node[name].addCallback("/*/*", control_callback)
             node[None].addNode(name, node[name])
+
+    def add_osc_direct_callback(self, address, callback, index=None,
+                                tabpages=None):
+        """
+        Add a callback for a single, fully specified control address, such as
+        one element of a multi-control.  Direct callbacks are found with a
+        dictionary lookup instead of pattern matching, and take precedence
+        over callbacks added with L{add_osc_callback}.
+        
+        The callback must have the function signature:
+        
+        C{callback(index, value_list, send_address)}
+        
+        @param address: control address below the tabpage (e.g. 'multi/3/4')
+        @type address: C{string}
+        @param callback: callback function to be called upon match.
+        @type callback: Function
+        @param index: Precomputed value passed to the callback, such as the
+        element index of the address.
+        @keyword tabpages: A tabpage name or list of tabpage names to add this
+        address to.  Defaults to all tabpage names of this handler.
+        @type tabpages: C{str} or C{list}
+        """
+        if type(tabpages) is list:
+            iter_tabpages = tabpages
+        elif type(tabpages) is str:
+            iter_tabpages = [tabpages]
+        else:
+            iter_tabpages = self.tabpage_names
+        for tabpage in iter_tabpages:
+            if tabpage not in self.tabpage_names:
+                rospy.logwarn("Tried to add address %s to tabpage %s" %
+                               (address, tabpage))
+                rospy.logwarn("Cannot add callbacks to an unaliased tabpage")
+                continue
+            self.osc_direct['/'.join(['', tabpage, address])] = (callback,
+                                                                 index)
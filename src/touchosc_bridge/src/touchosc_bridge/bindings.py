@@ -0,0 +1,393 @@
+"""
+Module for the bindings between TouchOSC controls and their ROS messages.
+
+Each control of a tabpage loaded by the L{DefaultTabpageHandler} is compiled
+into one binding object when the tabpage is loaded.  The binding holds the
+ROS message that is published for the control, with the fixed fields already
+filled in, and a lookup table from OSC address parts to element indices for
+multi-element controls, so that handling an OSC event is a single method
+call.  The concrete address of every element of a multi-element control is
+also registered as a direct callback, so that incoming element messages are
+dispatched with a single dictionary lookup.
+
+The values of multi-element controls are kept in float32 NumPy arrays that
+are updated in place and shared with the published message, which is
+serialized directly from the array buffer by C{rospy.numpy_msg}.
+"""
+import numpy
+from rospy.numpy_msg import numpy_msg
+from txosc import osc
+
+import pytouchosc.controls
+import touchosc_msgs.msg
+
+
+class ControlBinding(object):
+    """
+    Binding for controls that only have common properties (Battery, Time).
+
+    @cvar msg_type: ROS message type of the control topic
+    @cvar ros_cb: Name of the handler method called for ROS messages
+    @cvar receives: True if the control sends OSC messages to the bridge
+    """
+    msg_type = touchosc_msgs.msg.TouchOSC_Common
+    ros_cb = 'common_ros_cb'
+    receives = False
+
+    def __init__(self, handler, control_name):
+        """
+        @param handler: Handler of the tabpage that holds the control
+        @type handler: L{DefaultTabpageHandler}
+        @param control_name: Name of the control
+        @type control_name: C{str}
+        """
+        self.handler = handler
+        self.name = control_name
+        self.control_dict = handler.message_dict[control_name]
+        self.publisher = None
+        self.msg = self.msg_type()
+        self.msg.common = handler.ros_populate_common(control_name)
+
+    def publish(self, send_address):
+        """
+        Publish the control message on the control topic and/or mark the
+        control as changed for the tabpage state message.
+
+        @param send_address: IP and port of the originating client
+        @type send_address: C{tuple}
+        """
+        msg = self.msg
+        handler = self.handler
+        msg.header.stamp = handler.parent.arrival_stamp
+        msg.header.frame_id = send_address[0]
+        if handler.control_topics:
+            if self.publisher is None:
+                self.publisher = handler.get_publisher(self.name)
+            self.publisher.publish(msg)
+            handler.record_latency(msg.header.stamp)
+        if handler.state_publisher is not None:
+            handler.changed_controls.add(self.name)
+
+    def state_values(self):
+        """
+        Flattened values of the control, in the layout described by
+        C{touchosc_msgs/TabpageState}.
+
+        @rtype: C{list}
+        """
+        return []
+
+    def apply_values(self, values, text, to_send):
+        """
+        Set the control from ROS.  If its state changes, the OSC message
+        that updates the clients is appended to C{to_send}.
+
+        @param values: Flattened values, in the layout described by
+        C{touchosc_msgs/TabpageCommand}
+        @type values: C{list}
+        @param text: Text of the control, or None
+        @type text: C{str}
+        @param to_send: OSC messages to send
+        @type to_send: C{list}
+        """
+        pass
+
+    def direct_callbacks(self):
+        """
+        Concrete element addresses of the control below its tabpage.
+
+        @return: A list of (address, callback, index) tuples for
+        L{AbstractTabpageHandler.add_osc_direct_callback}
+        @rtype: C{list}
+        """
+        return []
+
+
+class LabelBinding(ControlBinding):
+    """
+    Binding for labels, which are only set from ROS.
+    """
+    msg_type = touchosc_msgs.msg.Label
+    ros_cb = 'label_ros_cb'
+
+    def apply_values(self, values, text, to_send):
+        if text is not None and text != self.control_dict['text']:
+            self.control_dict['text'] = text
+            to_send.append(osc.Message(self.name, text))
+
+
+class ScalableBinding(ControlBinding):
+    """
+    Binding for single value controls (Push Button, Toggle Button, Fader,
+    Rotary).
+    """
+    msg_type = touchosc_msgs.msg.ScalableControl
+    ros_cb = 'scalable_control_ros_cb'
+    receives = True
+
+    def __init__(self, handler, control_name):
+        super(ScalableBinding, self).__init__(handler, control_name)
+        self.msg.range = [self.control_dict['scalef'],
+                          self.control_dict['scalet']]
+
+    def osc_cb(self, address_list, value_list, send_address):
+        control_dict = self.control_dict
+        control_dict[None] = float(value_list[0])
+        self.msg.value = control_dict[None]
+        self.msg.z = control_dict['z']
+        self.publish(send_address)
+
+    def z_cb(self, address_list, value_list, send_address):
+        control_dict = self.control_dict
+        control_dict['z'] = bool(value_list[0])
+        self.msg.value = control_dict[None]
+        self.msg.z = control_dict['z']
+        self.publish(send_address)
+
+    def state_values(self):
+        return [self.control_dict[None], float(self.control_dict['z'])]
+
+    def apply_values(self, values, text, to_send):
+        if len(values) and values[0] != self.control_dict[None]:
+            self.control_dict[None] = values[0]
+            to_send.append(osc.Message(self.name, values[0]))
+
+
+class LEDBinding(ScalableBinding):
+    """
+    Binding for LEDs, which are only set from ROS.
+    """
+    receives = False
+
+
+class EncoderBinding(ScalableBinding):
+    """
+    Binding for encoders, whose value cannot be set from ROS.
+    """
+    ros_cb = 'common_ros_cb'
+
+    def apply_values(self, values, text, to_send):
+        pass
+
+
+class MultiButtonBinding(ControlBinding):
+    """
+    Binding for multi-toggles and multi-pushes.  Values are stored row-major
+    with C{dim_y} columns.
+    """
+    msg_type = numpy_msg(touchosc_msgs.msg.MultiButton)
+    ros_cb = 'multibutton_ros_cb'
+    receives = True
+
+    def __init__(self, handler, control_name):
+        super(MultiButtonBinding, self).__init__(handler, control_name)
+        dim_x = self.control_dict['dim_x']
+        dim_y = self.control_dict['dim_y']
+        self.msg.dimension = numpy.array([dim_x, dim_y], dtype=numpy.uint16)
+        self.msg.range = numpy.array([self.control_dict['scalef'],
+                                      self.control_dict['scalet']],
+                                     dtype=numpy.float32)
+        # (x, y) address parts -> index into the value list
+        self.index = {}
+        for x in range(dim_x):
+            for y in range(dim_y):
+                self.index[(str(x + 1), str(y + 1))] = y + x * dim_y
+        self.values = numpy.array(self.control_dict[None], dtype=numpy.float32)
+        self.control_dict[None] = self.values
+        self.msg.values = self.values
+
+    def osc_cb(self, address_list, value_list, send_address):
+        index = self.index.get(tuple(address_list[2:4]))
+        if index is not None:
+            self.element_cb(index, value_list, send_address)
+
+    def element_cb(self, index, value_list, send_address):
+        self.values[index] = value_list[0]
+        self.msg.z = self.control_dict['z']
+        self.publish(send_address)
+
+    def direct_callbacks(self):
+        return [('/'.join([self.name, x, y]), self.element_cb, index)
+                for ((x, y), index) in self.index.iteritems()]
+
+    def z_cb(self, address_list, value_list, send_address):
+        self.control_dict['z'] = bool(value_list[0])
+        self.msg.z = self.control_dict['z']
+        self.publish(send_address)
+
+    def state_values(self):
+        return self.values.tolist() + [float(self.control_dict['z'])]
+
+    def apply_values(self, values, text, to_send):
+        if (len(values) == len(self.values) and
+            not numpy.array_equal(values, self.values)):
+            self.values[:] = values
+            to_send.append(osc.Message(self.name, *self.values.tolist()))
+
+
+class MultiFaderBinding(ControlBinding):
+    """
+    Binding for multi-faders.
+    """
+    msg_type = numpy_msg(touchosc_msgs.msg.MultiFader)
+    ros_cb = 'multifader_ros_cb'
+    receives = True
+
+    def __init__(self, handler, control_name):
+        super(MultiFaderBinding, self).__init__(handler, control_name)
+        number = self.control_dict['number']
+        self.msg.dimension = number
+        self.msg.range = numpy.array([self.control_dict['scalef'],
+                                      self.control_dict['scalet']],
+                                     dtype=numpy.float32)
+        # Fader address part -> index into the value list
+        self.index = dict((str(i + 1), i) for i in range(number))
+        self.values = numpy.array(self.control_dict[None], dtype=numpy.float32)
+        self.control_dict[None] = self.values
+        self.msg.values = self.values
+
+    def osc_cb(self, address_list, value_list, send_address):
+        index = self.index.get(address_list[2] if len(address_list) > 2
+                               else None)
+        if index is not None:
+            self.element_cb(index, value_list, send_address)
+
+    def element_cb(self, index, value_list, send_address):
+        self.values[index] = value_list[0]
+        self.msg.z = self.control_dict['z']
+        self.publish(send_address)
+
+    def direct_callbacks(self):
+        return [('/'.join([self.name, number]), self.element_cb, index)
+                for (number, index) in self.index.iteritems()]
+
+    def z_cb(self, address_list, value_list, send_address):
+        self.control_dict['z'] = bool(value_list[0])
+        self.msg.z = self.control_dict['z']
+        self.publish(send_address)
+
+    def state_values(self):
+        return self.values.tolist() + [float(self.control_dict['z'])]
+
+    def apply_values(self, values, text, to_send):
+        if (len(values) == len(self.values) and
+            not numpy.array_equal(values, self.values)):
+            self.values[:] = values
+            to_send.append(osc.Message(self.name, *self.values.tolist()))
+
+
+class XYPadBinding(ControlBinding):
+    """
+    Binding for XY pads.
+    """
+    msg_type = touchosc_msgs.msg.XYPad
+    ros_cb = 'xypad_ros_cb'
+    receives = True
+
+    def __init__(self, handler, control_name):
+        super(XYPadBinding, self).__init__(handler, control_name)
+        self.msg.range = [self.control_dict['scalef'],
+                          self.control_dict['scalet']]
+
+    def osc_cb(self, address_list, value_list, send_address):
+        self.control_dict[None] = value_list
+        self.msg.x = value_list[0]
+        self.msg.y = value_list[1]
+        self.msg.z = self.control_dict['z']
+        self.publish(send_address)
+
+    def z_cb(self, address_list, value_list, send_address):
+        self.control_dict['z'] = value_list[0]
+        self.msg.x = self.control_dict[None][0]
+        self.msg.y = self.control_dict[None][1]
+        self.msg.z = self.control_dict['z']
+        self.publish(send_address)
+
+    def state_values(self):
+        return list(self.control_dict[None]) + [float(self.control_dict['z'])]
+
+    def apply_values(self, values, text, to_send):
+        values = list(values)
+        if len(values) == 2 and values != list(self.control_dict[None]):
+            self.control_dict[None] = values
+            to_send.append(osc.Message(self.name, *values))
+
+
+class MultiXYPadBinding(ControlBinding):
+    """
+    Binding for multi-touch XY pads with five touch points.
+    """
+    msg_type = numpy_msg(touchosc_msgs.msg.MultiXYPad)
+    ros_cb = 'common_ros_cb'
+    receives = True
+
+    def __init__(self, handler, control_name):
+        super(MultiXYPadBinding, self).__init__(handler, control_name)
+        self.msg.range = numpy.array([self.control_dict['scalef'],
+                                      self.control_dict['scalet']],
+                                     dtype=numpy.float32)
+        # Touch number address part -> index into the touch lists
+        self.index = dict((str(i + 1), i)
+                          for i in range(len(self.control_dict['x'])))
+        self.x = numpy.array(self.control_dict['x'], dtype=numpy.float32)
+        self.y = numpy.array(self.control_dict['y'], dtype=numpy.float32)
+        self.control_dict['x'] = self.x
+        self.control_dict['y'] = self.y
+        self.z = numpy.array(self.control_dict['z'], dtype=numpy.bool_)
+        self.control_dict['z'] = self.z
+        self.msg.x = self.x
+        self.msg.y = self.y
+        self.msg.z = self.z
+
+    def osc_cb(self, address_list, value_list, send_address):
+        index = self.index.get(address_list[2] if len(address_list) > 2
+                               else None)
+        if index is not None:
+            self.element_cb(index, value_list, send_address)
+
+    def z_cb(self, address_list, value_list, send_address):
+        index = self.index.get(address_list[2] if len(address_list) > 2
+                               else None)
+        if index is not None:
+            self.element_z_cb(index, value_list, send_address)
+
+    def element_cb(self, index, value_list, send_address):
+        self.x[index] = value_list[0]
+        self.y[index] = value_list[1]
+        self.publish(send_address)
+
+    def element_z_cb(self, index, value_list, send_address):
+        self.z[index] = bool(value_list[0])
+        if not bool(value_list[0]):
+            self.x[index] = 0.0
+            self.y[index] = 0.0
+        self.publish(send_address)
+
+    def direct_callbacks(self):
+        callbacks = []
+        for (touch, index) in self.index.iteritems():
+            callbacks.append(('/'.join([self.name, touch]), self.element_cb,
+                              index))
+            callbacks.append(('/'.join([self.name, touch, 'z']),
+                              self.element_z_cb, index))
+        return callbacks
+
+    def state_values(self):
+        return self.x.tolist() + self.y.tolist() + \
+            [float(z) for z in self.z]
+
+
+# Control class -> binding class.  Controls are matched on their exact class.
+BINDINGS = {
+    pytouchosc.controls.Button: ScalableBinding,
+    pytouchosc.controls.Dial: ScalableBinding,
+    pytouchosc.controls.LED: LEDBinding,
+    pytouchosc.controls.Time: ControlBinding,
+    pytouchosc.controls.TextField: ControlBinding,
+    pytouchosc.controls.Label: LabelBinding,
+    pytouchosc.controls.Encoder: EncoderBinding,
+    pytouchosc.controls.MultiButton: MultiButtonBinding,
+    pytouchosc.controls.MultiDial: MultiFaderBinding,
+    pytouchosc.controls.XYPad: XYPadBinding,
+    pytouchosc.controls.MultiXYPad: MultiXYPadBinding,
+}
@@ -2,16 +2,32 @@ import rospy
 
 from txosc import osc
 from txosc import dispatch
+from twisted.internet import reactor
 
 from abstracttabpage import AbstractTabpageHandler
-import pytouchosc
+from bindings import BINDINGS
 import touchosc_msgs.msg
-import rospy
 
 class DefaultTabpageHandler(AbstractTabpageHandler):
     """
     Child class of AbstractTabpageHandler to create ROS publishers and 
     subscribers for each of the controls in a loaded tabpage.
+    
+    Endpoints are created on demand: a control's publisher when it first
+    sends an OSC message, and its subscriber either at startup, if the
+    control is listed in the C{~<tabpage>/subscribe_controls} parameter, or
+    when a client first opens the tabpage.
+    
+    If C{~<tabpage>/publish_state} is set, the values of all controls that
+    changed are also published together at C{~<tabpage>/state_rate} as a
+    C{touchosc_msgs/TabpageState} on C{<node>/state/<tabpage>}.  The
+    per-control topics can then be turned off with
+    C{~<tabpage>/control_topics}.
+    
+    Many controls can be updated at once by publishing a
+    C{touchosc_msgs/TabpageCommand} on C{<node>/command/<tabpage>}, which
+    is sent to the clients as a single bundle.  This topic is subscribed at
+    startup.
     """
     def __init__(self, touchosc_interface, tabpage):
         """
@@ -30,64 +46,124 @@ class DefaultTabpageHandler(AbstractTabpageHandler):
                                                     [tabpage.name])
         self.tabpage = tabpage
         self.message_dict = self.tabpage.getMessages()
+        # Reject packets that do not match the layout before dispatch
+        self.osc_schema.update(self.tabpage.getSendTypeTags())
         ros_prefix = self.ros_name + '/' + self.tabpage_names[0] + '/'
+        # control name -> (topic, message type, ROS callback)
+        self.ros_endpoints = {}
+        # control name -> CommonProperties, kept up to date by
+        # osc_populate_common
+        self.common_msgs = {}
+        self.subscribed = False
+
+        # control name -> binding, see L{touchosc_bridge.bindings}
+        self.bindings = {}
 
         for control in self.tabpage.iterchildren():
-            control_type = type(control)
-            ros_cb = None
-            osc_cb = None
-            osc_z_cb = None
-            if control_type is pytouchosc.controls.Button or \
-                control_type is pytouchosc.controls.Dial:
-                msg_type = touchosc_msgs.msg.ScalableControl
-                ros_cb = self.scalable_control_ros_cb
-                osc_cb = self.scalable_control_osc_cb
-                osc_z_cb = self.scalable_control_z_osc_cb
-            elif control_type is pytouchosc.controls.LED:
-                msg_type = touchosc_msgs.msg.ScalableControl
-                ros_cb = self.scalable_control_ros_cb
-            elif control_type is pytouchosc.controls.Time or \
-                control_type is pytouchosc.controls.TextField:
-                msg_type = touchosc_msgs.msg.TouchOSC_Common
-                ros_cb = self.common_ros_cb
-            elif control_type is pytouchosc.controls.Label:
-                msg_type = touchosc_msgs.msg.Label
-                ros_cb = self.label_ros_cb
-            elif control_type is pytouchosc.controls.Encoder:
-                msg_type = touchosc_msgs.msg.ScalableControl
-                ros_cb = self.common_ros_cb
-                osc_cb = self.scalable_control_osc_cb
-                osc_z_cb = self.scalable_control_z_osc_cb
-            elif control_type is pytouchosc.controls.MultiButton:
-                msg_type = touchosc_msgs.msg.MultiButton
-                ros_cb = self.multibutton_ros_cb
-                osc_cb = self.multibutton_osc_cb
-                osc_z_cb = self.multibutton_z_osc_cb
-            elif control_type is pytouchosc.controls.MultiDial:
-                msg_type = touchosc_msgs.msg.MultiFader
-                ros_cb = self.multifader_ros_cb
-                osc_cb = self.multifader_osc_cb
-                osc_z_cb = self.multifader_z_osc_cb
-            elif control_type is pytouchosc.controls.XYPad:
-                msg_type = touchosc_msgs.msg.XYPad
-                ros_cb = self.xypad_ros_cb
-                osc_cb = self.xypad_osc_cb
-                osc_z_cb = self.xypad_z_osc_cb
-            elif control_type is pytouchosc.controls.MultiXYPad:
-                msg_type = touchosc_msgs.msg.MultiXYPad
-                ros_cb = self.common_ros_cb
-                osc_cb = self.multixypad_osc_cb
-                osc_z_cb = self.multixypad_z_osc_cb
-            if msg_type is not None:
-                address = ros_prefix + control.name
-                self.ros_subscribers[control.name] = rospy.Subscriber(address,
-                                                                      msg_type,
-                                                                      ros_cb)
-                self.ros_publishers[control.name] = rospy.Publisher(address,
-                                                                    msg_type)
-                if osc_cb:
-                    self.add_osc_callback(control.name, osc_cb,
-                                          z_callback=osc_z_cb)
+            try:
+                binding_class = BINDINGS[type(control)]
+            except KeyError:
+                continue
+            address = ros_prefix + control.name
+            self.ros_endpoints[control.name] = (address,
+                                                binding_class.msg_type,
+                                                getattr(self,
+                                                        binding_class.ros_cb))
+            self.common_msgs[control.name] = self.build_common(control.name)
+            binding = binding_class(self, control.name)
+            self.bindings[control.name] = binding
+            if binding.receives:
+                self.add_osc_callback(control.name, binding.osc_cb,
+                                      z_callback=binding.z_cb)
+                for (address, callback, index) in binding.direct_callbacks():
+                    self.add_osc_direct_callback(address, callback, index)
+
+        # A single topic, so commands are accepted before any client has
+        # opened the tabpage
+        self.command_subscriber = rospy.Subscriber(
+            self.ros_name + '/command/' + self.tabpage_names[0],
+            touchosc_msgs.msg.TabpageCommand, self.command_ros_cb)
+
+        subscribe_controls = rospy.get_param("~" + self.handler_name +
+                                             "/subscribe_controls", [])
+        for control_name in subscribe_controls:
+            if self.ros_endpoints.has_key(control_name):
+                self.subscribe_control(control_name)
+            else:
+                rospy.logwarn("Cannot subscribe to unknown control %s on %s" %
+                              (control_name, self.handler_name))
+
+        pref = "~" + self.handler_name + "/"
+        self.control_topics = rospy.get_param(pref + "control_topics", True)
+        self.changed_controls = set()
+        self.state_publisher = None
+        if rospy.get_param(pref + "publish_state", False):
+            self.state_rate = rospy.get_param(pref + "state_rate", 10.0)
+            if self.state_rate <= 0:
+                rospy.logwarn("%sstate_rate must be positive, got %s, "
+                              "using 10.0" % (pref, self.state_rate))
+                self.state_rate = 10.0
+            self.state_publisher = rospy.Publisher(self.ros_name + '/state/' +
+                                                   self.tabpage_names[0],
+                                                   touchosc_msgs.msg.TabpageState)
+            reactor.callLater(1.0 / self.state_rate, self.state_cb)
+
+    def get_publisher(self, control_name):
+        """
+        Get the publisher of a control, creating it on first use.
+        
+        @param control_name: Name of the control
+        @type control_name: C{str}
+        @rtype: C{rospy.Publisher}
+        """
+        try:
+            return self.ros_publishers[control_name]
+        except KeyError:
+            (address, msg_type, _) = self.ros_endpoints[control_name]
+            publisher = rospy.Publisher(address, msg_type)
+            self.ros_publishers[control_name] = publisher
+            return publisher
+
+    def subscribe_control(self, control_name):
+        """
+        Subscribe to the ROS topic of a control, if not already subscribed.
+        
+        @param control_name: Name of the control
+        @type control_name: C{str}
+        """
+        if not self.ros_subscribers.has_key(control_name):
+            (address, msg_type, ros_cb) = self.ros_endpoints[control_name]
+            self.ros_subscribers[control_name] = rospy.Subscriber(address,
+                                                                  msg_type,
+                                                                  ros_cb)
+
+    def state_cb(self):
+        """
+        Publish the controls that changed since the last call as one
+        C{touchosc_msgs/TabpageState} message.
+        """
+        if self.changed_controls:
+            msg = touchosc_msgs.msg.TabpageState()
+            msg.header.stamp = rospy.Time.now()
+            msg.tabpage = self.tabpage_names[0]
+            for control_name in sorted(self.changed_controls):
+                values = self.bindings[control_name].state_values()
+                msg.names.append(control_name)
+                msg.counts.append(len(values))
+                msg.values.extend(values)
+            self.changed_controls.clear()
+            self.state_publisher.publish(msg)
+        reactor.callLater(1.0 / self.state_rate, self.state_cb)
+
+    def cb_tabpage_active(self, client, tabpage):
+        """
+        Subscribe to the topics of all controls the first time a client
+        opens the tabpage.
+        """
+        if not self.subscribed:
+            self.subscribed = True
+            for control_name in self.ros_endpoints:
+                self.subscribe_control(control_name)
 
     def osc_populate_common(self, msg):
         try:
@@ -100,39 +176,60 @@ class DefaultTabpageHandler(AbstractTabpageHandler):
 
         to_send = []
         control_dict = self.message_dict[control_name]
+        common = self.common_msgs[control_name]
         if msg.common.color != '':
             to_send.append(osc.Message('/'.join([control_name, 'color']),
                                       msg.common.color))
             control_dict['color'] = msg.common.color
-        if (msg.common.x != 0
-            and msg.common.x != int(control_dict['position']['x'])):
+            common.color = msg.common.color
+        if msg.common.x != 0 and msg.common.x != common.x:
             to_send.append(osc.Message('/'.join([control_name, 'position/x']),
                                        msg.common.x))
             control_dict['position']['x'] = msg.common.x
-        if (msg.common.y != 0
-            and msg.common.y != int(control_dict['position']['y'])):
+            common.x = msg.common.x
+        if msg.common.y != 0 and msg.common.y != common.y:
             to_send.append(osc.Message('/'.join([control_name, 'position/y']),
                                       msg.common.y))
             control_dict['position']['y'] = msg.common.y
-        if (msg.common.width != 0
-            and msg.common.width != int(control_dict['size']['w'])):
+            common.y = msg.common.y
+        if msg.common.width != 0 and msg.common.width != common.width:
             to_send.append(osc.Message('/'.join([control_name, 'size/w']),
                                       msg.common.width))
             control_dict['size']['w'] = msg.common.width
-        if (msg.common.height != 0
-            and msg.common.height != int(control_dict['size']['h'])):
+            common.width = msg.common.width
+        if msg.common.height != 0 and msg.common.height != common.height:
             to_send.append(osc.Message('/'.join([control_name, 'size/h']),
                                       msg.common.height))
             control_dict['size']['h'] = msg.common.height
+            common.height = msg.common.height
         if msg.common.visible != '':
             send = 0 if msg.common.visible.lower() == 'false' else 1
             if bool(send) != bool(control_dict['visibility']):
                 to_send.append(osc.Message('/'.join([control_name, 'visible']),
                                           send))
                 control_dict['visibility'] = bool(send)
+                common.visible = str(bool(send))
         return (control_name, control_dict, to_send)
 
     def ros_populate_common(self, control_name):
+        """
+        Get the CommonProperties of a control.  The message is shared between
+        all messages published for the control and must not be modified.
+        
+        @param control_name: Name of the control
+        @type control_name: C{str}
+        @rtype: C{touchosc_msgs/CommonProperties}
+        """
+        return self.common_msgs[control_name]
+
+    def build_common(self, control_name):
+        """
+        Build the CommonProperties of a control from its layout values.
+        
+        @param control_name: Name of the control
+        @type control_name: C{str}
+        @rtype: C{touchosc_msgs/CommonProperties}
+        """
         common_msg = touchosc_msgs.msg.CommonProperties()
         control_dict = self.message_dict[control_name]
         common_msg.tabpage = self.tabpage_names[0]
@@ -160,9 +257,7 @@ class DefaultTabpageHandler(AbstractTabpageHandler):
         try:
             if msg._connection_header['callerid'] != self.ros_name:
                 (control, control_dict, to_send) = self.osc_populate_common(msg)
-                if msg.value != control_dict[None]:
-                    control_dict[None] = msg.value
-                    to_send.append(osc.Message(control, msg.value))
+                self.bindings[control].apply_values([msg.value], None, to_send)
                 self.send_osc_message(msg.header.frame_id, to_send)
         except KeyError:
             pass
@@ -171,9 +266,7 @@ class DefaultTabpageHandler(AbstractTabpageHandler):
         try:
             if msg._connection_header['callerid'] != self.ros_name:
                 (control, control_dict, to_send) = self.osc_populate_common(msg)
-                if msg.value != control_dict['text']:
-                    control_dict['text'] = msg.value
-                    to_send.append(osc.Message(control, msg.value))
+                self.bindings[control].apply_values([], msg.value, to_send)
                 self.send_osc_message(msg.header.frame_id, to_send)
         except KeyError:
             pass
@@ -182,9 +275,7 @@ class DefaultTabpageHandler(AbstractTabpageHandler):
         try:
             if msg._connection_header['callerid'] != self.ros_name:
                 (control, control_dict, to_send) = self.osc_populate_common(msg)
-                if list(msg.values) != control_dict[None]:
-                    control_dict[None] = list(msg.values)
-                    to_send.append(osc.Message(control, *control_dict[None]))
+                self.bindings[control].apply_values(msg.values, None, to_send)
                 self.send_osc_message(msg.header.frame_id, to_send)
         except KeyError:
             pass
@@ -193,9 +284,7 @@ class DefaultTabpageHandler(AbstractTabpageHandler):
         try:
             if msg._connection_header['callerid'] != self.ros_name:
                 (control, control_dict, to_send) = self.osc_populate_common(msg)
-                if list(msg.values) != control_dict[None]:
-                    control_dict[None] = list(msg.values)
-                    to_send.append(osc.Message(control, *control_dict[None]))
+                self.bindings[control].apply_values(msg.values, None, to_send)
                 self.send_osc_message(msg.header.frame_id, to_send)
         except KeyError:
             pass
@@ -204,156 +293,44 @@ class DefaultTabpageHandler(AbstractTabpageHandler):
         try:
             if msg._connection_header['callerid'] != self.ros_name:
                 (control, control_dict, to_send) = self.osc_populate_common(msg)
-                if [msg.x, msg.y] != control_dict[None]:
-                    control_dict[None] = [msg.x, msg.y]
-                    to_send.append(osc.Message(control, *control_dict[None]))
+                self.bindings[control].apply_values([msg.x, msg.y], None,
+                                                    to_send)
                 self.send_osc_message(msg.header.frame_id, to_send)
         except KeyError:
             pass
 
-    def scalable_control_osc_cb(self, address_list, value_list, send_address):
-        control_name = address_list[1]
-        control_dict = self.message_dict[control_name]
-        control_dict[None] = float(value_list[0])
-        msg = touchosc_msgs.msg.ScalableControl()
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = send_address[0]
-        msg.common = self.ros_populate_common(control_name)
-        msg.range = [control_dict['scalef'], control_dict['scalet']]
-        msg.z = control_dict['z']
-        msg.value = control_dict[None]
-        self.ros_publishers[control_name].publish(msg)
-
-    def scalable_control_z_osc_cb(self, address_list, value_list, send_address):
-        control_name = address_list[1]
-        control_dict = self.message_dict[control_name]
-        control_dict['z'] = bool(value_list[0])
-        msg = touchosc_msgs.msg.ScalableControl()
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = send_address[0]
-        msg.common = self.ros_populate_common(control_name)
-        msg.range = [control_dict['scalef'], control_dict['scalet']]
-        msg.z = control_dict['z']
-        msg.value = control_dict[None]
-        self.ros_publishers[control_name].publish(msg)
-
-    def multibutton_osc_cb(self, address_list, value_list, send_address):
-        control_name = address_list[1]
-        control_dict = self.message_dict[control_name]
-        x = int(address_list[2]) - 1
-        y = int(address_list[3]) - 1
-        control_dict[None][y + x * control_dict['dim_y']] = value_list[0]
-        msg = touchosc_msgs.msg.MultiButton()
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = send_address[0]
-        msg.common = self.ros_populate_common(control_name)
-        msg.dimension = [control_dict['dim_x'], control_dict['dim_y']]
-        msg.range = [control_dict['scalef'], control_dict['scalet']]
-        msg.z = control_dict['z']
-        msg.values = control_dict[None]
-        self.ros_publishers[control_name].publish(msg)
-
-    def multibutton_z_osc_cb(self, address_list, value_list, send_address):
-        control_name = address_list[1]
-        control_dict = self.message_dict[control_name]
-        control_dict['z'] = bool(value_list[0])
-        msg = touchosc_msgs.msg.MultiButton()
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = send_address[0]
-        msg.common = self.ros_populate_common(control_name)
-        msg.dimension = [control_dict['dim_x'], control_dict['dim_y']]
-        msg.range = [control_dict['scalef'], control_dict['scalet']]
-        msg.z = control_dict['z']
-        msg.values = control_dict[None]
-        self.ros_publishers[control_name].publish(msg)
-
-    def multifader_osc_cb(self, address_list, value_list, send_address):
-        control_name = address_list[1]
-        control_dict = self.message_dict[control_name]
-        pos = int(address_list[2]) - 1
-        control_dict[None][pos] = value_list[0]
-        msg = touchosc_msgs.msg.MultiFader()
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = send_address[0]
-        msg.common = self.ros_populate_common(control_name)
-        msg.dimension = control_dict['number']
-        msg.range = [control_dict['scalef'], control_dict['scalet']]
-        msg.z = control_dict['z']
-        msg.values = control_dict[None]
-        self.ros_publishers[control_name].publish(msg)
-
-    def multifader_z_osc_cb(self, address_list, value_list, send_address):
-        control_name = address_list[1]
-        control_dict = self.message_dict[control_name]
-        control_dict['z'] = bool(value_list[0])
-        msg = touchosc_msgs.msg.MultiFader()
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = send_address[0]
-        msg.common = self.ros_populate_common(control_name)
-        msg.dimension = control_dict['number']
-        msg.range = [control_dict['scalef'], control_dict['scalet']]
-        msg.z = control_dict['z']
-        msg.values = control_dict[None]
-        self.ros_publishers[control_name].publish(msg)
-
-    def multixypad_osc_cb(self, address_list, value_list, send_address):
-        control_name = address_list[1]
-        control_dict = self.message_dict[control_name]
-        touch_number = int(address_list[2])
-        control_dict['x'][touch_number - 1] = value_list[0]
-        control_dict['y'][touch_number - 1] = value_list[1]
-        msg = touchosc_msgs.msg.MultiXYPad()
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = send_address[0]
-        msg.common = self.ros_populate_common(control_name)
-        msg.range = [control_dict['scalef'], control_dict['scalet']]
-        msg.z = control_dict['z']
-        msg.x = control_dict['x']
-        msg.y = control_dict['y']
-        self.ros_publishers[control_name].publish(msg)
-
-    def multixypad_z_osc_cb(self, address_list, value_list, send_address):
-        control_name = address_list[1]
-        control_dict = self.message_dict[control_name]
-        touch_number = int(address_list[2])
-        control_dict['z'][touch_number - 1] = bool(value_list[0])
-        if not bool(value_list[0]):
-            control_dict['x'][touch_number - 1] = 0.0
-            control_dict['y'][touch_number - 1] = 0.0
-        msg = touchosc_msgs.msg.MultiXYPad()
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = send_address[0]
-        msg.common = self.ros_populate_common(control_name)
-        msg.range = [control_dict['scalef'], control_dict['scalet']]
-        msg.z = control_dict['z']
-        msg.x = control_dict['x']
-        msg.y = control_dict['y']
-        self.ros_publishers[control_name].publish(msg)
-
-    def xypad_osc_cb(self, address_list, value_list, send_address):
-        control_name = address_list[1]
-        control_dict = self.message_dict[control_name]
-        control_dict[None] = value_list
-        msg = touchosc_msgs.msg.XYPad()
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = send_address[0]
-        msg.common = self.ros_populate_common(control_name)
-        msg.range = [control_dict['scalef'], control_dict['scalet']]
-        msg.x = control_dict[None][0]
-        msg.y = control_dict[None][1]
-        msg.z = control_dict['z']
-        self.ros_publishers[control_name].publish(msg)
-
-    def xypad_z_osc_cb(self, address_list, value_list, send_address):
-        control_name = address_list[1]
-        control_dict = self.message_dict[control_name]
-        control_dict['z'] = value_list[0]
-        msg = touchosc_msgs.msg.XYPad()
-        msg.header.stamp = rospy.Time.now()
-        msg.header.frame_id = send_address[0]
-        msg.common = self.ros_populate_common(control_name)
-        msg.range = [control_dict['scalef'], control_dict['scalet']]
-        msg.x = control_dict[None][0]
-        msg.y = control_dict[None][1]
-        msg.z = control_dict['z']
-        self.ros_publishers[control_name].publish(msg)
+    def command_ros_cb(self, msg):
+        """
+        Apply a batch of control updates and send all resulting changes as
+        one bundle.
+        """
+        try:
+            if msg._connection_header['callerid'] == self.ros_name:
+                return
+        except KeyError:
+            return
+        if len(msg.counts) != len(msg.names):
+            rospy.logwarn("Command on %s has %d counts for %d names" %
+                          (self.handler_name, len(msg.counts), len(msg.names)))
+            return
+        if sum(msg.counts) > len(msg.values):
+            rospy.logwarn("Command on %s has %d values, counts need %d" %
+                          (self.handler_name, len(msg.values),
+                           sum(msg.counts)))
+            return
+        to_send = []
+        start = 0
+        for i in range(len(msg.names)):
+            control = msg.names[i]
+            values = list(msg.values[start:start + msg.counts[i]])
+            start += msg.counts[i]
+            try:
+                binding = self.bindings[control]
+            except KeyError:
+                rospy.logwarn("Command for unknown control %s on %s" %
+                              (control, self.handler_name))
+                continue
+            text = msg.texts[i] if i < len(msg.texts) else None
+            binding.apply_values(values, text, to_send)
+        if to_send:
+            self.send_osc_message(msg.header.frame_id, to_send)
@@ -217,6 +217,9 @@ class TouchOscInterface(OscInterface):
             diagnostic_status_clients.values.append(KeyValue(
                                     key=client.address + " Tabpages",
                                     value=", ".join(client.tabpages)))
+        diagnostic_status_clients.values.append(KeyValue(
+                                key="Rejected messages",
+                                value=str(self._osc_receiver.rejected)))
         if len(self.clients) == 0:
             diagnostic_status_clients.message = "No clients detected"
         msg.status.append(diagnostic_status_clients)
@@ -246,6 +249,9 @@ class TouchOscInterface(OscInterface):
             for tabpage_name, node in osc_nodes.iteritems():
                 self._osc_receiver.addNode(tabpage_name, node)
                 self.tabpage_handlers[tabpage_name] = handler
+            for address, (callback, index) in handler.osc_direct.iteritems():
+                self._osc_receiver.addDirectCallback(address, callback, index)
+            self._osc_receiver.addSchema(handler.osc_schema)
 
     def cb_ros_switch_tabpage(self, msg):
         if msg._connection_header['callerid'] != self.ros_name:
@@ -276,7 +282,7 @@ class TouchOscInterface(OscInterface):
         msg.linear_acceleration.z = value_list[2] * 9.80665
 
         msg.header.frame_id = send_address[0]
-        msg.header.stamp = rospy.Time.now()
+        msg.header.stamp = self.arrival_stamp
         # Covariance was calculated from about 20 minutes of static data
         # Conditions:
         #    * Back down
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import roslib
+
+import unittest
+
+import rospy
+
+from touchosc_bridge.bindings import BINDINGS
+import pytouchosc.controls as controls
+from pytouchosc.tabpage import Tabpage
+
+
+class FakeParent(object):
+    arrival_stamp = rospy.Time(1, 0)
+
+
+class FakePublisher(object):
+    def __init__(self):
+        self.published = []
+
+    def publish(self, msg):
+        self.published.append(msg)
+
+
+class FakeHandler(object):
+    """
+    The parts of DefaultTabpageHandler that bindings use.
+    """
+    def __init__(self, tabpage):
+        self.parent = FakeParent()
+        self.message_dict = tabpage.getMessages()
+        self.control_topics = True
+        self.state_publisher = None
+        self.changed_controls = set()
+        self.publishers = {}
+        self.latencies = []
+
+    def ros_populate_common(self, control_name):
+        return None
+
+    def get_publisher(self, control_name):
+        return self.publishers.setdefault(control_name, FakePublisher())
+
+    def record_latency(self, stamp):
+        self.latencies.append(stamp)
+
+
+def make_control(control_type, name):
+    control = controls.control_factory(control_type, name)
+    control.scalef = 0.0
+    control.scalet = 1.0
+    return control
+
+
+class Test_Bindings(unittest.TestCase):
+    def setUp(self):
+        self.tabpage = Tabpage()
+        self.tabpage.name = "tab"
+        # Controls built outside a parsed layout only keep their class while
+        # the Python object is alive
+        self.controls = {}
+        for (control_type, name) in [("faderh", "fader"),
+                                     ("multitoggle", "mt"),
+                                     ("multifaderh", "mf"),
+                                     ("xy", "xy"),
+                                     ("multixy", "mxy"),
+                                     ("encoder", "enc")]:
+            self.controls[name] = make_control(control_type, name)
+            self.tabpage.append(self.controls[name])
+        self.handler = FakeHandler(self.tabpage)
+        self.bindings = {}
+        for (name, control) in self.controls.iteritems():
+            self.bindings[name] = BINDINGS[type(control)](self.handler, name)
+        self.client = ("10.0.0.2", 9000)
+
+    def direct(self, name):
+        return dict((address, (callback, index)) for (address, callback, index)
+                    in self.bindings[name].direct_callbacks())
+
+    def sent_addresses(self, name):
+        """
+        Addresses below the tabpage that TouchOSC sends for a control.
+        """
+        return set(self.controls[name].getSendableTypeTags().keys())
+
+    def test_multibutton_osc_and_element_cb(self):
+        binding = self.bindings["mt"]
+        binding.osc_cb(["tab", "mt", "2", "3"], [1.0], self.client)
+        # Row-major with dim_y (6) columns
+        self.assertEqual(binding.values[1 * 6 + 2], 1.0)
+        (callback, index) = self.direct("mt")["mt/2/3"]
+        self.assertEqual(index, 1 * 6 + 2)
+        callback(index, [0.0], self.client)
+        self.assertEqual(binding.values.tolist(), [0.0] * 30)
+        self.assertEqual(len(self.handler.publishers["mt"].published), 2)
+
+    def test_multifader_osc_and_element_cb(self):
+        binding = self.bindings["mf"]
+        binding.osc_cb(["tab", "mf", "4"], [0.5], self.client)
+        self.assertEqual(binding.values[3], 0.5)
+        (callback, index) = self.direct("mf")["mf/4"]
+        callback(index, [0.25], self.client)
+        self.assertEqual(binding.values.tolist(), [0.0, 0.0, 0.0, 0.25, 0.0])
+
+    def test_multixy_osc_and_element_cb(self):
+        binding = self.bindings["mxy"]
+        binding.osc_cb(["tab", "mxy", "2"], [0.5, 0.25], self.client)
+        self.assertEqual((binding.x[1], binding.y[1]), (0.5, 0.25))
+        (callback, index) = self.direct("mxy")["mxy/2"]
+        callback(index, [0.75, 0.5], self.client)
+        self.assertEqual((binding.x[1], binding.y[1]), (0.75, 0.5))
+        (callback, index) = self.direct("mxy")["mxy/2/z"]
+        callback(index, [0.0], self.client)
+        self.assertEqual((binding.x[1], binding.y[1], binding.z[1]),
+                         (0.0, 0.0, False))
+
+    def test_direct_callbacks_match_layout(self):
+        self.assertEqual(set(self.direct("mt")),
+                         self.sent_addresses("mt") - set(["mt/z"]))
+        self.assertEqual(set(self.direct("mf")),
+                         self.sent_addresses("mf") - set(["mf/z"]))
+        self.assertEqual(set(self.direct("mxy")), self.sent_addresses("mxy"))
+        self.assertEqual(self.direct("fader"), {})
+        self.assertEqual(self.direct("xy"), {})
+
+    def test_state_values(self):
+        self.bindings["fader"].osc_cb(["tab", "fader"], [0.5], self.client)
+        self.assertEqual(self.bindings["fader"].state_values(), [0.5, 0.0])
+        self.assertEqual(self.bindings["mt"].state_values(), [0.0] * 31)
+        self.assertEqual(self.bindings["mf"].state_values(), [0.0] * 6)
+        self.bindings["xy"].osc_cb(["tab", "xy"], [0.25, 0.75], self.client)
+        self.assertEqual(self.bindings["xy"].state_values(), [0.25, 0.75, 0.0])
+        self.bindings["mxy"].osc_cb(["tab", "mxy", "1"], [0.5, 0.25],
+                                    self.client)
+        self.bindings["mxy"].z_cb(["tab", "mxy", "1", "z"], [1.0],
+                                  self.client)
+        self.assertEqual(self.bindings["mxy"].state_values(),
+                         [0.5, 0.0, 0.0, 0.0, 0.0,
+                          0.25, 0.0, 0.0, 0.0, 0.0,
+                          1.0, 0.0, 0.0, 0.0, 0.0])
+
+    def test_z_cb_keeps_value(self):
+        fader = self.bindings["fader"]
+        fader.osc_cb(["tab", "fader"], [0.5], self.client)
+        fader.z_cb(["tab", "fader", "z"], [0.0], self.client)
+        self.assertEqual(fader.msg.value, 0.5)
+        self.assertEqual(fader.state_values(), [0.5, 0.0])
+        mt = self.bindings["mt"]
+        mt.osc_cb(["tab", "mt", "1", "1"], [1.0], self.client)
+        mt.z_cb(["tab", "mt", "z"], [1.0], self.client)
+        self.assertEqual(mt.values[0], 1.0)
+        self.assertTrue(mt.msg.z)
+        xy = self.bindings["xy"]
+        xy.osc_cb(["tab", "xy"], [0.25, 0.75], self.client)
+        xy.z_cb(["tab", "xy", "z"], [0.0], self.client)
+        self.assertEqual((xy.msg.x, xy.msg.y), (0.25, 0.75))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+import roslib
+
+import unittest
+
+import rospy
+import touchosc_msgs.msg
+
+from touchosc_bridge.defaulttabpage import DefaultTabpageHandler
+from pytouchosc.tabpage import Tabpage
+
+from test_bindings import FakeParent, make_control
+
+
+class FakeEndpoint(object):
+    """
+    Stands in for rospy.Publisher and rospy.Subscriber, which need a master.
+    """
+    def __init__(self, name, data_class, callback=None):
+        self.name = name
+        self.published = []
+
+    def publish(self, msg):
+        self.published.append(msg)
+
+
+class FakeInterface(FakeParent):
+    """
+    The parts of TouchOscInterface that a handler uses without clients.
+    """
+    clients = {}
+
+
+class Test_DefaultTabpageHandler(unittest.TestCase):
+    def setUp(self):
+        self.params = {}
+        self.saved = (rospy.get_param, rospy.Publisher, rospy.Subscriber)
+        rospy.get_param = self.params.get
+        rospy.Publisher = FakeEndpoint
+        rospy.Subscriber = FakeEndpoint
+        self.tabpage = Tabpage()
+        self.tabpage.name = "tab"
+        # Controls built outside a parsed layout only keep their class while
+        # the Python object is alive
+        self.controls = {}
+        for (control_type, name) in [("faderh", "fader"),
+                                     ("multitoggle", "mt"),
+                                     ("labelh", "label")]:
+            self.controls[name] = make_control(control_type, name)
+            self.tabpage.append(self.controls[name])
+        self.client = ("10.0.0.2", 9000)
+        self.sent = []
+
+    def tearDown(self):
+        (rospy.get_param, rospy.Publisher, rospy.Subscriber) = self.saved
+
+    def make_handler(self):
+        return DefaultTabpageHandler(FakeInterface(), self.tabpage)
+
+    def test_publisher_on_first_message(self):
+        handler = self.make_handler()
+        self.assertEqual(handler.ros_publishers, {})
+        handler.bindings["fader"].osc_cb(["tab", "fader"], [0.5], self.client)
+        publisher = handler.ros_publishers["fader"]
+        self.assertEqual(len(publisher.published), 1)
+        handler.bindings["fader"].osc_cb(["tab", "fader"], [0.25],
+                                         self.client)
+        self.assertTrue(handler.get_publisher("fader") is publisher)
+        self.assertEqual(handler.ros_publishers.keys(), ["fader"])
+
+    def test_subscribers_on_tabpage_active(self):
+        handler = self.make_handler()
+        self.assertEqual(handler.ros_subscribers, {})
+        handler.cb_tabpage_active(self.client[0], "tab")
+        self.assertEqual(sorted(handler.ros_subscribers),
+                         ["fader", "label", "mt"])
+        subscribers = dict(handler.ros_subscribers)
+        handler.cb_tabpage_active(self.client[0], "tab")
+        self.assertEqual(handler.ros_subscribers, subscribers)
+
+    def test_subscribe_controls_param(self):
+        self.params["~tab/subscribe_controls"] = ["mt", "missing"]
+        handler = self.make_handler()
+        self.assertEqual(handler.ros_subscribers.keys(), ["mt"])
+
+    def test_common_cached(self):
+        handler = self.make_handler()
+        common = handler.ros_populate_common("fader")
+        self.assertEqual((common.tabpage, common.name), ("tab", "fader"))
+        self.assertTrue(handler.ros_populate_common("fader") is common)
+        handler.bindings["fader"].osc_cb(["tab", "fader"], [0.5], self.client)
+        handler.bindings["fader"].osc_cb(["tab", "fader"], [0.25],
+                                         self.client)
+        published = handler.ros_publishers["fader"].published
+        self.assertTrue(published[0].common is common)
+        self.assertTrue(published[1].common is common)
+
+    def test_common_updated_from_ros(self):
+        handler = self.make_handler()
+        common = handler.ros_populate_common("fader")
+        msg = touchosc_msgs.msg.ScalableControl()
+        msg.common = touchosc_msgs.msg.CommonProperties(color="purple",
+                                                        x=common.x + 10,
+                                                        visible="false")
+        msg._connection_header = {'topic': handler.ros_name + '/tab/fader'}
+        (_, _, to_send) = handler.osc_populate_common(msg)
+        self.assertEqual(set(m.address for m in to_send),
+                         set(["fader/color", "fader/position/x",
+                              "fader/visible"]))
+        common = handler.ros_populate_common("fader")
+        self.assertEqual((common.color, common.x, common.visible),
+                         ("purple", msg.common.x, "False"))
+        self.assertEqual(handler.message_dict["fader"]["color"], "purple")
+        # Unchanged position and visibility are not resent
+        (_, _, to_send) = handler.osc_populate_common(msg)
+        addresses = [m.address for m in to_send]
+        self.assertFalse("fader/position/x" in addresses)
+        self.assertFalse("fader/visible" in addresses)
+
+    def command(self, names, counts, values, texts=[]):
+        msg = touchosc_msgs.msg.TabpageCommand(names=names, counts=counts,
+                                               values=values, texts=texts)
+        msg._connection_header = {'callerid': '/other'}
+        return msg
+
+    def test_command_subscribed_at_startup(self):
+        handler = self.make_handler()
+        self.assertTrue(
+            handler.command_subscriber.name.endswith("/command/tab"))
+        self.assertEqual(handler.ros_subscribers, {})
+
+    def test_command(self):
+        handler = self.make_handler()
+        handler.send_osc_message = lambda frame_id, to_send: \
+            self.sent.append(to_send)
+        handler.command_ros_cb(self.command(["fader", "label", "mt"],
+                                            [1, 0, 30],
+                                            [0.5] + [0.0] * 29 + [1.0],
+                                            ["", "hello", ""]))
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(dict((m.address, m.getValues())
+                              for m in self.sent[0]),
+                         {"fader": [0.5], "label": ["hello"],
+                          "mt": [0.0] * 29 + [1.0]})
+        self.assertEqual(handler.message_dict["fader"][None], 0.5)
+        self.assertEqual(handler.bindings["mt"].values[29], 1.0)
+
+    def test_command_length_mismatch(self):
+        handler = self.make_handler()
+        handler.send_osc_message = lambda frame_id, to_send: \
+            self.sent.append(to_send)
+        # Fewer counts than names
+        handler.command_ros_cb(self.command(["fader", "mt"], [1], [0.5]))
+        # Counts need more values than were sent
+        handler.command_ros_cb(self.command(["fader", "mt"], [1, 30],
+                                            [0.5, 1.0]))
+        self.assertEqual(self.sent, [])
+        self.assertEqual(handler.message_dict["fader"][None], 0.0)
+
+    def test_command_unknown_control(self):
+        handler = self.make_handler()
+        handler.send_osc_message = lambda frame_id, to_send: \
+            self.sent.append(to_send)
+        handler.command_ros_cb(self.command(["missing", "fader"], [2, 1],
+                                            [1.0, 1.0, 0.25]))
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual([(m.address, m.getValues()) for m in self.sent[0]],
+                         [("fader", [0.25])])
+
+    def test_state_rate_param(self):
+        self.params["~tab/publish_state"] = True
+        self.params["~tab/state_rate"] = 0
+        handler = self.make_handler()
+        self.assertEqual(handler.state_rate, 10.0)
+        self.params["~tab/state_rate"] = 4.0
+        handler = self.make_handler()
+        self.assertEqual(handler.state_rate, 4.0)
+
+
+if __name__ == "__main__":
+    unittest.main()